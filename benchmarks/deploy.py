@@ -0,0 +1,374 @@
+import argparse
+import functools
+import io
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STANDINS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'standins')
+RESULT_MARKER = 'BENCHMARK_RESULT '
+BUILD = '9999'
+BUILD_SHA = 'f' * 40
+
+# Sizes are multiplied by --scale, qbox is roughly the Qbox recipe, large is a handful of big asset packs
+PROFILES = {
+    'small': {'repos': 5, 'files': 20, 'file_size': 4096, 'sql_files': 1, 'sql_rows': 1000, 'packs': 0, 'pack_size': 0},
+    'qbox': {'repos': 45, 'files': 60, 'file_size': 8192, 'sql_files': 6, 'sql_rows': 5000, 'packs': 1, 'pack_size': 8 << 20},
+    'large': {'repos': 8, 'files': 40, 'file_size': 8192, 'sql_files': 2, 'sql_rows': 2000, 'packs': 4, 'pack_size': 64 << 20},
+}
+PACK_FORMATS = ['.zip', '.tar.gz', '.tar.xz']
+
+def payload(rng, size):
+    # Half random, half text, so archives compress about as well as real resources
+    words = [b'local', b'function', b'end', b'return', b'Config', b'player', b'vehicle', b'true', b'false']
+    text = b' '.join(rng.choice(words) for _ in range(size // 12))
+    return (rng.randbytes(size // 2) + text)[:size]
+
+def build_repo(path, files):
+    # fast-import writes a whole commit in one process, far quicker than add + commit for many repos
+    subprocess.run(['git', 'init', '--bare', '--quiet', path], check=True)
+    subprocess.run(['git', '--git-dir', path, 'symbolic-ref', 'HEAD', 'refs/heads/main'], check=True)
+    stream = io.BytesIO()
+    message = b'benchmark fixture'
+    stream.write(b'commit refs/heads/main\ncommitter Bench <bench@example.com> 0 +0000\n')
+    stream.write(b'data %d\n%s\n' % (len(message), message))
+    for name, content in files:
+        stream.write(b'M 100644 inline %s\ndata %d\n%s\n' % (name.encode(), len(content), content))
+    subprocess.run(['git', '--git-dir', path, 'fast-import', '--quiet'], input=stream.getvalue(), check=True)
+
+def sql_file(rng, table, rows):
+    lines = [f"CREATE TABLE IF NOT EXISTS `{table}` (`id` int NOT NULL, `name` varchar(64), `data` longtext, PRIMARY KEY (`id`));\n"]
+    for start in range(0, rows, 100):
+        values = []
+        for row in range(start, min(start + 100, rows)):
+            # Quotes, semicolons and comment markers inside strings keep the statement splitter honest
+            values.append(f"({row}, 'item_{row}', '{{\"label\": \"it''s; -- #{rng.randint(0, 1 << 30)}\"}}')")
+        lines.append(f"INSERT INTO `{table}` VALUES {', '.join(values)};\n")
+    return ''.join(lines).encode()
+
+def build_archive(path, files):
+    if path.endswith('.zip'):
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as zip_ref:
+            for name, content in files:
+                zip_ref.writestr(name, content)
+        return
+    mode = 'w:gz' if path.endswith('.tar.gz') else 'w:xz'
+    options = {'compresslevel': 1} if mode == 'w:gz' else {'preset': 1}
+    with tarfile.open(path, mode, **options) as tar_ref:
+        for name, content in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar_ref.addfile(info, io.BytesIO(content))
+
+def build_fixtures(root, scale):
+    rng = random.Random(0)
+    www = os.path.join(root, 'www')
+    repos = os.path.join(root, 'repos')
+    os.makedirs(os.path.join(www, 'artifacts', f"{BUILD}-{BUILD_SHA}"), exist_ok=True)
+    os.makedirs(os.path.join(www, 'recipes'), exist_ok=True)
+    os.makedirs(os.path.join(www, 'packs'), exist_ok=True)
+    os.makedirs(repos, exist_ok=True)
+
+    # Artifact index, with older builds so the parser has something to skip
+    anchors = [f'<a class="panel-block" href="./{build}-{build:040x}/fx.tar.xz">{build}</a>' for build in range(9000, 9999)]
+    anchors.insert(0, f'<a class="panel-block" href="./{BUILD}-{BUILD_SHA}/fx.tar.xz">LATEST RECOMMENDED ({BUILD})</a>')
+    with open(os.path.join(www, 'artifacts', 'index.html'), 'w') as file:
+        file.write('<html><body>' + '\n'.join(anchors) + '</body></html>')
+    artifact_files = [(f"alpine/opt/cfx-server/citizen/scripting/file{index}.bin", payload(rng, int(64 * 1024 * scale)))
+                      for index in range(400)]
+    artifact_name = 'server.7z' if os.name == 'nt' else 'fx.tar.xz'
+    artifact_path = os.path.join(www, 'artifacts', f"{BUILD}-{BUILD_SHA}", artifact_name)
+    if artifact_name == 'server.7z':
+        import py7zr
+        with py7zr.SevenZipFile(artifact_path, 'w') as zip7_ref:
+            for name, content in artifact_files:
+                zip7_ref.writestr(content, name)
+    else:
+        build_archive(artifact_path, artifact_files)
+    build_archive(os.path.join(www, 'monitor.zip'), [(f"monitor/file{index}.js", payload(rng, 16384)) for index in range(50)])
+
+    index = []
+    for profile, settings in PROFILES.items():
+        sql = [(f"sql/install{number}.sql", sql_file(rng, f"{profile}_{number}", int(settings['sql_rows'] * scale)))
+               for number in range(settings['sql_files'])]
+        tasks = [{'action': 'connect_database'}] if sql else []
+        for number in range(settings['repos']):
+            name = f"{profile}-resource{number}"
+            files = [(f"client/file{file}.lua", payload(rng, int(settings['file_size'] * scale)))
+                     for file in range(settings['files'])]
+            files.append(('fxmanifest.lua', b"fx_version 'cerulean'\ngame 'gta5'\n"))
+            if number == 0:
+                files += sql
+            build_repo(os.path.join(repos, f"{name}.git"), files)
+            tasks.append({'action': 'download_github', 'src': f"file://{os.path.join(repos, name)}.git", 'ref': 'main',
+                          'dest': f"./resources/[{profile}]/{name}"})
+
+        # A monorepo pack that only one folder is taken from
+        monorepo = f"{profile}-monorepo"
+        build_repo(os.path.join(repos, f"{monorepo}.git"),
+                   [(f"{folder}/file{file}.lua", payload(rng, 4096)) for folder in ('a', 'b', 'c') for file in range(30)])
+        tasks.append({'action': 'download_github', 'src': f"file://{os.path.join(repos, monorepo)}.git", 'ref': 'main',
+                      'dest': f"./resources/[{profile}]/{monorepo}", 'subpath': 'b'})
+
+        for number in range(settings['packs']):
+            extension = PACK_FORMATS[number % len(PACK_FORMATS)]
+            name = f"{profile}-pack{number}{extension}"
+            file_size = 1 << 20
+            files = [(f"stream/model{file}.ytd", payload(rng, file_size))
+                     for file in range(max(1, int(settings['pack_size'] * scale) // file_size))]
+            build_archive(os.path.join(www, 'packs', name), files)
+            tasks.append({'action': 'download_file', 'url': f"{{server}}/packs/{name}", 'path': f"./tmp/{name}"})
+            tasks.append({'action': 'unzip', 'src': f"./tmp/{name}", 'dest': f"./resources/[assets]/pack{number}"})
+        if settings['packs']:
+            tasks.append({'action': 'remove_path', 'path': './tmp'})
+
+        first = f"./resources/[{profile}]/{profile}-resource0"
+        tasks += [{'action': 'query_database', 'file': f"{first}/{name}"} for name, _ in sql]
+        tasks += [
+            {'action': 'ensure_dir', 'path': './resources/[local]'},
+            {'action': 'copy_path', 'src': f"{first}/fxmanifest.lua", 'dest': './resources/[local]/fxmanifest.lua'},
+            {'action': 'write_file', 'file': './server.cfg',
+             'data': 'endpoint_add_tcp "0.0.0.0:30120"\n{{serverEndpoints}}\nsv_licenseKey "{{svLicense}}"\n'
+                     'sv_hostname "{{serverName}}"\nsv_maxclients {{maxClients}}\n'
+                     'set mysql_connection_string "{{dbConnectionString}}"\n'},
+        ]
+        recipe = {'name': f"Benchmark {profile}", 'author': 'benchmarks', 'description': f"{profile} benchmark recipe", 'tasks': tasks}
+        with open(os.path.join(www, 'recipes', f"{profile}.yaml"), 'w') as file:
+            json.dump(recipe, file)
+        index.append({'name': recipe['name'], 'url': f"{{server}}/recipes/{profile}.yaml"})
+    with open(os.path.join(www, 'recipes', 'index.json'), 'w') as file:
+        json.dump(index, file)
+
+class LimitedReader:
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        size = self.remaining if size < 0 else min(size, self.remaining)
+        chunk = self.file.read(size)
+        self.remaining -= len(chunk)
+        return chunk
+
+    def close(self):
+        self.file.close()
+
+class FixtureHandler(SimpleHTTPRequestHandler):
+    # Byte ranges and keep-alive, so ranged and resumed downloads take the same paths as against a CDN
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def end_headers(self):
+        self.send_header('Accept-Ranges', 'bytes')
+        super().end_headers()
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if os.path.dirname(path).endswith('recipes') and os.path.isfile(path):
+            # Recipes point back at this server, whose port is only known once it is listening
+            with open(path, 'rb') as file:
+                body = file.read().replace(b'{server}', f"http://{self.headers['Host']}".encode())
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            return io.BytesIO(body)
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', '').strip())
+        if not match or not os.path.isfile(path):
+            return super().send_head()
+        size = os.path.getsize(path)
+        start = int(match.group(1))
+        end = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+        if start >= size:
+            self.send_error(416)
+            return None
+        file = open(path, 'rb')
+        file.seek(start)
+        self.send_response(206)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        return LimitedReader(file, end - start + 1)
+
+def start_server(www):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(FixtureHandler, directory=www))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def load_recipe(www, profile, server_url):
+    with open(os.path.join(www, 'recipes', f"{profile}.yaml"), 'r') as file:
+        return json.loads(file.read().replace('{server}', server_url))
+
+def peak_memory():
+    try:
+        import resource
+    except ImportError:
+        return {}
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    memory = {'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 2 ** 20, 1)}
+    # Linux carries ru_maxrss over from the forked harness through exec, VmHWM starts fresh with the new image
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status', 'r') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    memory['peak_rss_mb'] = round(int(line.split()[1]) / 1024, 1)
+    return memory
+
+def run_child(case):
+    # Runs one case in a fresh interpreter, so peak memory and module state belong to that case alone
+    if not case['mysql']:
+        sys.path.insert(0, STANDINS)
+    sys.path.insert(0, REPO_ROOT)
+    os.chdir(case['cwd'])
+    import deploy_server
+
+    start = time.perf_counter()
+    if case['mode'] == 'recipe':
+        sql_info = case['sql_info']
+        with deploy_server.trace_span('deploy', 'run'):
+            deploy_server.validate_sql_connection(sql_info)
+            with deploy_server.trace_span('recipe'):
+                succeeded = deploy_server.process_recipe(case['recipe'], 'bench', sql_info, jobs=case['jobs'])
+    else:
+        sys.argv = ['deploy_server.py', '--yes', '--jobs', str(case['jobs'])]
+        deploy_server.main()
+        succeeded = os.path.exists(os.path.join('fxServer', 'txData', 'bench', 'server.cfg'))
+    wall = time.perf_counter() - start
+
+    result = {'succeeded': succeeded, 'wall_s': round(wall, 3), 'summary': deploy_server.trace_summary()}
+    result.update(peak_memory())
+    print(RESULT_MARKER + json.dumps(result))
+
+def run_case(workdir, www, server_url, profile, mode, cache, args):
+    cache_dir = os.path.join(workdir, f"cache-{profile}-{mode}")
+    if cache == 'cold' and os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    cwd = os.path.join(workdir, f"{profile}-{mode}-{cache}")
+    if os.path.exists(cwd):
+        shutil.rmtree(cwd)
+    os.makedirs(cwd)
+    shutil.copy(os.path.join(REPO_ROOT, 'example_config.json'), cwd)
+
+    sql_info = dict(args.sql_info, db=f"bench_{profile}_{mode}_{cache}")
+    recipe_url = f"{server_url}/recipes/{profile}.yaml"
+    with open(os.path.join(cwd, 'deploy.json'), 'w') as file:
+        json.dump({
+            'artifact': BUILD, 'recipeUrl': recipe_url, 'sqlServer': sql_info['ip'], 'sqlPort': sql_info['port'],
+            'sqlUser': sql_info['user'], 'sqlPass': sql_info['password'], 'sqlDb': sql_info['db'],
+            'serverName': 'Benchmark', 'deployFolder': 'bench', 'svLicenseKey': 'cfxk_benchmark', 'maxClients': '48',
+            'removeGit': False
+        }, file)
+    case = {
+        'mode': mode, 'cwd': cwd, 'jobs': args.jobs, 'mysql': args.mysql is not None, 'sql_info': sql_info,
+        'recipe': load_recipe(www, profile, server_url)
+    }
+    case_path = os.path.join(cwd, 'case.json')
+    with open(case_path, 'w') as file:
+        json.dump(case, file)
+
+    env = dict(os.environ,
+               FXDEPLOY_CACHE_DIR=cache_dir,
+               FXDEPLOY_ARTIFACTS_URL=f"{server_url}/artifacts/",
+               FXDEPLOY_RECIPES_URL=f"{server_url}/recipes/index.json",
+               FXDEPLOY_TXADMIN_URL=f"{server_url}/monitor.zip")
+    with open(os.path.join(cwd, 'output.log'), 'w') as log:
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', case_path],
+                                 stdout=subprocess.PIPE, stderr=log, text=True, env=env)
+        log.write(process.stdout)
+    lines = [line for line in process.stdout.splitlines() if line.startswith(RESULT_MARKER)]
+    if process.returncode != 0 or not lines:
+        return {'succeeded': False, 'error': f"exit status {process.returncode}, see {os.path.join(cwd, 'output.log')}"}
+    return json.loads(lines[-1][len(RESULT_MARKER):])
+
+def parse_mysql(value):
+    match = re.fullmatch(r'([^:@]+)(?::([^@]*))?@([^:]+)(?::(\d+))?', value)
+    if not match:
+        raise argparse.ArgumentTypeError("expected user:password@host:port")
+    return {'user': match.group(1), 'password': match.group(2) or '', 'ip': match.group(3), 'port': int(match.group(4) or 3306)}
+
+def print_results(results, baseline):
+    print(f"\n{'case':<24} {'wall':>8} {'peak RSS':>10}  stages")
+    for name, result in results.items():
+        if not result.get('succeeded'):
+            print(f"{name:<24} failed: {result.get('error', 'deploy did not finish')}")
+            continue
+        stages = ', '.join(f"{stage['name']} {stage['wall_s']:.2f}s" for stage in result['summary']['stages'])
+        line = f"{name:<24} {result['wall_s']:>7.2f}s {result.get('peak_rss_mb', 0):>8.1f}MB  {stages}"
+        previous = (baseline or {}).get(name)
+        if previous and previous.get('succeeded'):
+            line += f"  ({previous['wall_s'] / result['wall_s']:.2f}x vs baseline)"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run representative deploys against local stand-ins for every remote service.")
+    parser.add_argument('--profiles', default='small,qbox', help=f"comma separated, any of {', '.join(PROFILES)}")
+    parser.add_argument('--modes', default='recipe,main', help="process_recipe alone and/or the whole main() pipeline")
+    parser.add_argument('--scale', type=float, default=1.0, help="multiplies every fixture size")
+    parser.add_argument('--jobs', type=int, default=8)
+    parser.add_argument('--workdir', help="keep fixtures and deploys here instead of a temporary folder")
+    parser.add_argument('--mysql', type=parse_mysql, metavar='USER:PASSWORD@HOST:PORT',
+                        help="import into a real MySQL server instead of the in-process stand-in")
+    parser.add_argument('--output', help="write the results as JSON, to compare releases with --baseline")
+    parser.add_argument('--baseline', help="results JSON of an earlier run to compare against")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        with open(args.child, 'r') as file:
+            run_child(json.load(file))
+        return
+
+    profiles = [profile for profile in args.profiles.split(',') if profile]
+    unknown = [profile for profile in profiles if profile not in PROFILES]
+    if unknown:
+        parser.error(f"unknown profile {', '.join(unknown)}")
+    args.sql_info = args.mysql or {'user': 'root', 'password': '', 'ip': '127.0.0.1', 'port': 3306}
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='fxdeploy-bench-')
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)['results']
+
+    try:
+        fixtures = os.path.join(workdir, f"fixtures-{args.scale}")
+        if not os.path.exists(os.path.join(fixtures, 'www', 'recipes', 'index.json')):
+            print(f"Building fixtures in {fixtures}...")
+            start = time.perf_counter()
+            build_fixtures(fixtures, args.scale)
+            print(f"Fixtures ready in {time.perf_counter() - start:.1f}s")
+        www = os.path.join(fixtures, 'www')
+        server, server_url = start_server(www)
+        results = {}
+        for profile in profiles:
+            for mode in [mode for mode in args.modes.split(',') if mode]:
+                for cache in ('cold', 'warm'):
+                    name = f"{profile}/{mode}/{cache}"
+                    print(f"Running {name}...")
+                    results[name] = run_case(workdir, www, server_url, profile, mode, cache, args)
+        server.shutdown()
+        print_results(results, baseline)
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump({'scale': args.scale, 'jobs': args.jobs, 'results': results}, file, indent=2)
+        sys.exit(0 if all(result.get('succeeded') for result in results.values()) else 1)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import zipfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+def make_payload(root, files, file_size):
+    # Half random, half repetitive so every codec has something to do
+    rng = random.Random(0)
+    words = [bytes(rng.choice(b'abcdefghijklmnopqrstuvwxyz') for _ in range(8)) for _ in range(512)]
+    for index in range(files):
+        path = os.path.join(root, f"stream/{index % 16}/file{index}.bin")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(rng.randbytes(file_size // 2))
+            f.write(b' '.join(rng.choice(words) for _ in range(file_size // 18)))
+    return sum(os.path.getsize(os.path.join(folder, name)) for folder, _, names in os.walk(root) for name in names)
+
+def make_archives(payload, workdir):
+    archives = {}
+    archives['zip'] = os.path.join(workdir, 'payload.zip')
+    with zipfile.ZipFile(archives['zip'], 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        for folder, _, names in os.walk(payload):
+            for name in names:
+                path = os.path.join(folder, name)
+                zip_ref.write(path, os.path.relpath(path, payload))
+
+    archives['tar.xz'] = os.path.join(workdir, 'payload.tar.xz')
+    xz = shutil.which('xz')
+    if xz:
+        # Multi-threaded compression writes independent blocks, the same as the cfx artifacts
+        with open(archives['tar.xz'], 'wb') as out:
+            tar = subprocess.Popen(['tar', '-C', payload, '-cf', '-', '.'], stdout=subprocess.PIPE)
+            subprocess.run([xz, '-T0', '-6', '-c'], stdin=tar.stdout, stdout=out, check=True)
+            tar.wait()
+    else:
+        with tarfile.open(archives['tar.xz'], 'w:xz') as tar_ref:
+            tar_ref.add(payload, arcname='.')
+
+    try:
+        import py7zr
+    except ImportError:
+        return archives
+    archives['7z'] = os.path.join(workdir, 'payload.7z')
+    with py7zr.SevenZipFile(archives['7z'], 'w') as zip7_ref:
+        zip7_ref.writeall(os.path.join(payload, 'stream'), arcname='stream')
+    return archives
+
+def baseline_extract(archive, dest):
+    if archive.endswith('.zip'):
+        with zipfile.ZipFile(archive, 'r') as zip_ref:
+            zip_ref.extractall(dest)
+    elif archive.endswith('.tar.xz'):
+        with tarfile.open(archive, 'r:xz') as tar_ref:
+            tar_ref.extractall(dest)
+    else:
+        import py7zr
+        with py7zr.SevenZipFile(archive, mode='r') as zip7_ref:
+            zip7_ref.extractall(path=dest)
+
+def measure(extract, archive, workdir, runs):
+    timings = []
+    for run in range(runs):
+        dest = os.path.join(workdir, f"out-{run}")
+        start = time.perf_counter()
+        extract(archive, dest)
+        timings.append(time.perf_counter() - start)
+        shutil.rmtree(dest)
+    return min(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare extract_archive throughput against single-threaded extraction.")
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--files', type=int, default=64)
+    parser.add_argument('--file-size', type=int, default=4 * 1024 * 1024)
+    args = parser.parse_args()
+
+    import deploy_server
+    with tempfile.TemporaryDirectory() as workdir:
+        payload = os.path.join(workdir, 'payload')
+        total = make_payload(payload, args.files, args.file_size) / (1024 * 1024)
+        archives = make_archives(payload, workdir)
+        print(f"payload: {args.files} files, {total:.0f} MB")
+        for archive_format, archive in archives.items():
+            baseline = measure(baseline_extract, archive, workdir, args.runs)
+            current = measure(deploy_server.extract_archive, archive, workdir, args.runs)
+            print(f"{archive_format:>7}: baseline {total / baseline:7.1f} MB/s, "
+                  f"extract_archive {total / current:7.1f} MB/s ({baseline / current:.2f}x)")
+
+if __name__ == '__main__':
+    main()
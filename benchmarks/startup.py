@@ -0,0 +1,75 @@
+import argparse
+import io
+import os
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+# Modules that must only be imported once a deploy actually needs them
+LAZY_MODULES = ['mysql.connector', 'py7zr', 'bs4', 'pyinputplus', 'tqdm']
+
+def measure_import(runs):
+    timings = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import deploy_server'],
+                                cwd=REPO_ROOT, capture_output=True, text=True)
+        if result.returncode != 0:
+            print(result.stderr)
+            sys.exit(1)
+        for line in result.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            fields = [field.strip() for field in line.split('|')]
+            if len(fields) == 3 and fields[2] == 'deploy_server':
+                timings.append(int(fields[1]) / 1000)
+    return min(timings)
+
+def loaded_lazy_modules():
+    code = f"import sys, deploy_server; print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, '-c', code], cwd=REPO_ROOT, capture_output=True, text=True)
+    return [module for module in result.stdout.strip().split(',') if module]
+
+def synthetic_index(builds):
+    lines = ['<html><body><div class="panel">']
+    for build in range(builds, 0, -1):
+        label = f"LATEST RECOMMENDED ({build})" if build == builds // 2 else str(build)
+        lines.append(f'<a class="panel-block" href="./{build}-{build:040x}/fx.tar.xz">\n'
+                     f'  <span class="icon"></span>\n  <span>{label}</span>\n</a>')
+    lines.append('</div></body></html>')
+    return '\n'.join(lines)
+
+def measure_parse(builds, runs):
+    import deploy_server
+    html = synthetic_index(builds)
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        parsed, recommended = deploy_server.parse_build_index(io.StringIO(html), 'https://example/', r'(\d+)-[\da-f]+/fx\.tar\.xz')
+        timings.append((time.perf_counter() - start) * 1000)
+    if len(parsed) != builds or recommended != str(builds // 2):
+        print(f"Parser returned {len(parsed)} builds and recommended {recommended}")
+        sys.exit(1)
+    return min(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure deploy_server import time and artifact index parsing.")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--builds', type=int, default=10000, help="builds in the synthetic artifact index")
+    parser.add_argument('--max-import-ms', type=float, default=250.0)
+    parser.add_argument('--max-parse-ms', type=float, default=250.0)
+    args = parser.parse_args()
+
+    import_ms = measure_import(args.runs)
+    lazy_loaded = loaded_lazy_modules()
+    parse_ms = measure_parse(args.builds, args.runs)
+    print(f"import deploy_server: {import_ms:.1f} ms (limit {args.max_import_ms:.0f} ms)")
+    print(f"parse {args.builds} builds: {parse_ms:.1f} ms (limit {args.max_parse_ms:.0f} ms)")
+    print(f"heavy modules loaded at import: {', '.join(lazy_loaded) or 'none'}")
+
+    failed = lazy_loaded or import_ms > args.max_import_ms or parse_ms > args.max_parse_ms
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
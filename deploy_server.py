@@ -1,5 +1,8 @@
 import os
 import re
+import argparse
+import hashlib
+import time
 import requests
 import yaml
 import tarfile
@@ -8,50 +11,687 @@ import subprocess
 import zipfile
 import random
 import string
-import mysql.connector
-import pyinputplus as pyip
+import sys
+import threading
+import traceback
 import json
-import py7zr
-from bs4 import BeautifulSoup
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
 from getpass import getpass
-from mysql.connector import Error
-from tqdm import tqdm
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlencode, urlsplit
+
+CACHE_DIR = os.environ.get('FXDEPLOY_CACHE_DIR', '.deploy_cache')
+ARTIFACT_CACHE_DIR = os.path.join(CACHE_DIR, 'artifacts')
+ARTIFACT_CACHE_SIZE = int(os.environ.get('FXDEPLOY_ARTIFACT_CACHE_SIZE', 4 * 1024 ** 3))
+GIT_CACHE_DIR = os.path.join(CACHE_DIR, 'git')
+HTTP_CACHE_DIR = os.path.join(CACHE_DIR, 'http')
+FILE_CACHE_DIR = os.path.join(CACHE_DIR, 'files')
+SQL_BATCH_SIZE = 500
+FAST_SQL_SESSION = {'foreign_key_checks': 0, 'unique_checks': 0}
+HTTP_CACHE_TTL = int(os.environ.get('FXDEPLOY_HTTP_CACHE_TTL', 300))
+GIT_CACHE_ENABLED = os.environ.get('FXDEPLOY_GIT_CACHE', '1') != '0'
+# Remote endpoints, overridable so deploys can run against mirrors or the offline benchmark fixtures
+ARTIFACTS_URL = os.environ.get('FXDEPLOY_ARTIFACTS_URL', 'https://runtime.fivem.net/artifacts/fivem/build_server_windows/master/'
+                               if os.name == 'nt' else 'https://runtime.fivem.net/artifacts/fivem/build_proot_linux/master/')
+RECIPES_INDEX_URL = os.environ.get('FXDEPLOY_RECIPES_URL', 'https://raw.githubusercontent.com/solareon/fxserver-recipes/main/index.json')
+TXADMIN_URL = os.environ.get('FXDEPLOY_TXADMIN_URL', 'https://github.com/tabarra/txAdmin/releases/latest/download/monitor.zip')
+# git clone --sparse and sparse-checkout cone mode
+SPARSE_GIT_VERSION = (2, 27)
+# Branches and tags only, a full mirror would also pull every pull request ref a host like GitHub advertises
+GIT_MIRROR_REFSPECS = ['+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*']
+FICLONE = 0x40049409
+COPY_JOBS = min(32, (os.cpu_count() or 1) * 4)
+REMOVE_JOBS = min(16, (os.cpu_count() or 1) * 2)
+TRASH_DIR = '.deploy_trash'
+EXTRACT_JOBS = min(16, os.cpu_count() or 1)
+EXTRACT_WORKER_BYTES = 8 * 1024 * 1024
+SYSTEM_EXTRACTORS_ENABLED = os.environ.get('FXDEPLOY_SYSTEM_EXTRACTORS', '1') != '0'
+# tar based formats can be decoded straight off the HTTP response, zip and 7z need random access
+STREAMABLE_ARCHIVES = {
+    '.tar.xz': 'xz',
+    '.tar.gz': 'gz',
+    '.tgz': 'gz',
+    '.tar.bz2': 'bz2',
+    '.tar': '',
+}
+
+DOWNLOAD_SETTINGS = {
+    'retries': 3,
+    'backoff': 1.0,
+    'connections': 4,
+    'min_split_size': 32 * 1024 * 1024,
+    'peer': os.environ.get('FXDEPLOY_PEER') or None,
+}
+DOWNLOAD_BLOCK_SIZE = 64 * 1024
+# Sizes, byte ranges and checksums all refer to the bytes on the wire, so never let a server compress them
+IDENTITY_ENCODING = {'Accept-Encoding': 'identity'}
+DOWNLOAD_TIMEOUT = (15, 60)
+# A peer may pull a file from upstream before it answers, but an unreachable peer should fail fast
+PEER_TIMEOUT = (5, 900)
+PEER_PORT = 8730
+# Hosts a peer fetches from besides the artifact, txAdmin and recipe index hosts, comma separated
+PEER_HOSTS = {host.strip().lower() for host in os.environ.get('FXDEPLOY_PEER_HOSTS', '').split(',') if host.strip()}
+# ssh sources are cloned with the peer's own keys, so they are only mirrored when the operator allows it
+PEER_GIT_SSH = os.environ.get('FXDEPLOY_PEER_GIT_SSH', '0') != '0'
+SCP_GIT_PATTERN = re.compile(r'[\w.-]+@([\w.-]+):(?!/)')
+
+http_session = None
+http_session_guard = threading.Lock()
+trash_executor = None
+trash_futures = []
+trash_guard = threading.Lock()
+git_mirror_locks = {}
+reflink_unsupported = set()
+git_version_info = None
+trace_events = []
+trace_totals = {}
+trace_guard = threading.Lock()
+trace_local = threading.local()
+trace_profilers = []
+profile_enabled = False
+git_mirror_locks_guard = threading.Lock()
+peer_locks = {}
+peer_checked = {}
+peer_guard = threading.Lock()
+peer_mirrors = set()
+git_mirror_refresh = True
+sql_pool_size = 0
+daemon_jobs = {}
+daemon_guard = threading.Lock()
+daemon_warm = {}
+daemon_warm_guard = threading.Lock()
+daemon_pool = None
+daemon_queue = None
+daemon_installer = None
+daemon_install = None
 
 # utility functions
-def download_file(url, dest):
-    response = requests.get(url, stream=True, allow_redirects=True)
-    if response.status_code == 200:
-        total_size = int(response.headers.get('content-length', 0))
-        block_size = 8192
-        progress_bar = tqdm(total=total_size, unit='B', unit_scale=True, desc=os.path.basename(dest))
-        
-        # Create the directory if it doesn't exist
-        if os.path.dirname(dest) and not os.path.exists(os.path.dirname(dest)):
-            os.makedirs(os.path.dirname(dest), exist_ok=True)
-        
-        with open(dest, 'wb') as file:
-            for chunk in response.iter_content(chunk_size=block_size):
-                file.write(chunk)
-                progress_bar.update(len(chunk))
-        progress_bar.close()
-        return True
+# instrumentation
+def count(counter, amount=1):
+    # Adds to the innermost span of this thread and to the run totals
+    spans = getattr(trace_local, 'spans', None)
+    if spans:
+        counters = spans[-1]['counters']
+        counters[counter] = counters.get(counter, 0) + amount
+    with trace_guard:
+        trace_totals[counter] = trace_totals.get(counter, 0) + amount
+
+@contextmanager
+def trace_span(name, category='stage', **args):
+    spans = trace_local.__dict__.setdefault('spans', [])
+    span = {'counters': {}}
+    profiler = None
+    if profile_enabled and getattr(trace_local, 'profiler', None) is None:
+        # cProfile only sees the thread that enabled it, so every worker thread gets its own profiler
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            trace_local.profiler = profiler
+        except ValueError:
+            # Python 3.12+ profiles through sys.monitoring, the profiler already running sees every thread
+            profiler = None
+    spans.append(span)
+    timestamp = time.time_ns() // 1000
+    start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield span
+    finally:
+        spans.pop()
+        wall = time.perf_counter() - start
+        cpu = time.thread_time() - cpu_start
+        if profiler:
+            profiler.disable()
+            trace_local.profiler = None
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': timestamp,
+            'dur': int(wall * 1e6),
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'thread': threading.current_thread().name,
+            'args': dict(args, cpu_ms=round(cpu * 1000, 1), **span['counters'])
+        }
+        with trace_guard:
+            trace_events.append(event)
+            if profiler:
+                trace_profilers.append(profiler)
+
+def write_trace(path):
+    # Chrome trace event format, opens in chrome://tracing and ui.perfetto.dev
+    with trace_guard:
+        events = [{key: value for key, value in event.items() if key != 'thread'} for event in trace_events]
+        threads = {(event['pid'], event['tid']): event['thread'] for event in trace_events}
+    events += [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+               for (pid, tid), name in threads.items()]
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+
+def trace_summary():
+    with trace_guard:
+        events = sorted(trace_events, key=lambda event: event['ts'])
+        totals = dict(trace_totals)
+    entries = {}
+    for event in events:
+        entry = {'name': event['name'], 'wall_s': round(event['dur'] / 1e6, 3), 'pid': event['pid']}
+        entry.update(event['args'])
+        entries.setdefault(event['cat'], []).append(entry)
+    run = entries.get('run', [{}])[0]
+    return {
+        'elapsed_s': run.get('wall_s'),
+        'totals': totals,
+        'stages': entries.get('stage', []),
+        'tasks': entries.get('task', []),
+    }
+
+def write_profile(path):
+    import pstats
+    with trace_guard:
+        profilers = list(trace_profilers)
+    if not profilers:
+        return
+    stats = pstats.Stats(profilers[0])
+    for profiler in profilers[1:]:
+        stats.add(profiler)
+    stats.dump_stats(path)
+    print(f"Profile written to {path}, the 25 most expensive calls:")
+    stats.sort_stats('cumulative').print_stats(25)
+
+def get_session():
+    global http_session
+    with http_session_guard:
+        if http_session is None:
+            # One keep-alive pool shared by every request the deployer makes
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=32)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            http_session = session
+    return http_session
+
+def http_cache_paths(url):
+    key = hashlib.sha256(url.encode()).hexdigest()
+    name = os.path.basename(url.split('?', 1)[0].rstrip('/')) or 'index'
+    return os.path.join(HTTP_CACHE_DIR, f"{key}.json"), os.path.join(HTTP_CACHE_DIR, f"{key}-{name}")
+
+def cached_get(url, ttl=None):
+    # Returns the path of the cached body and whether it changed since the last fetch
+    ttl = HTTP_CACHE_TTL if ttl is None else ttl
+    meta_path, body_path = http_cache_paths(url)
+    meta = None
+    if os.path.exists(meta_path) and os.path.exists(body_path):
+        try:
+            with open(meta_path, 'r') as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            # Unreadable metadata is a cache miss, the fetch below rewrites it
+            meta = None
+        if meta and time.time() - meta.get('fetched', 0) < ttl:
+            return body_path, False
+
+    headers = {}
+    if meta and meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta and meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    try:
+        response = peer_get('http', url, headers=headers) or \
+            get_session().get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT)
+        if response.status_code == 304 and meta:
+            changed = False
+        else:
+            response.raise_for_status()
+            os.makedirs(HTTP_CACHE_DIR, exist_ok=True)
+            staging = f"{body_path}.{os.getpid()}-{threading.get_ident()}"
+            with open(staging, 'wb') as file:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_BLOCK_SIZE):
+                    file.write(chunk)
+            count('bytes_downloaded', os.path.getsize(staging))
+            os.replace(staging, body_path)
+            meta = {
+                'url': url,
+                'etag': response.headers.get('etag'),
+                'last_modified': response.headers.get('last-modified'),
+            }
+            changed = True
+    except requests.RequestException as e:
+        if not meta:
+            raise
+        print(f"Could not revalidate {url}, using cached copy ({e})")
+        return body_path, False
+
+    meta['fetched'] = time.time()
+    staging = f"{meta_path}.{os.getpid()}-{threading.get_ident()}"
+    with open(staging, 'w') as file:
+        json.dump(meta, file, indent=2)
+    os.replace(staging, meta_path)
+    return body_path, changed
+
+def fetch_cached_file(url, dest):
+    try:
+        body_path, _ = cached_get(url)
+    except requests.RequestException as e:
+        print(f"Failed to download file: {e}")
+        return False
+    if os.path.dirname(dest):
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+    clone_file(body_path, dest)
+    return True
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def encoded(response):
+    return response.headers.get('content-encoding', 'identity').lower() not in ('', 'identity')
+
+def probe_download(url):
+    try:
+        response = get_session().head(url, allow_redirects=True, headers=IDENTITY_ENCODING,
+                                      timeout=request_timeout(url))
+    except requests.RequestException:
+        return 0, False
+    if response.status_code >= 400 or encoded(response):
+        return 0, False, None
+    total_size = int(response.headers.get('content-length', 0))
+    ranged = total_size > 0 and response.headers.get('accept-ranges', '').lower() == 'bytes'
+    return total_size, ranged, response_validators(response)
+
+def load_download_state(state_path, url, total_size, part_path):
+    if not os.path.exists(state_path) or not os.path.exists(part_path):
+        return None
+    try:
+        with open(state_path, 'r') as file:
+            state = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if state.get('url') != url or state.get('size') != total_size:
+        return None
+    return state
+
+def save_download_state(state_path, state, lock):
+    with lock:
+        with open(state_path, 'w') as file:
+            json.dump(state, file)
+
+def download_segment(url, segment, part_path, ranged, progress_bar, state_path, state, lock, digest=None):
+    # segment is [start, end, done], end is inclusive and None when the size is unknown
+    # digest hashes the file as it is written, it is only passed for a single segment that starts out empty
+    start, end, _ = segment
+    last_error = None
+    for attempt in range(DOWNLOAD_SETTINGS['retries'] + 1):
+        if attempt:
+            delay = DOWNLOAD_SETTINGS['backoff'] * 2 ** (attempt - 1)
+            print(f"Retrying {os.path.basename(part_path)} in {delay:.0f}s ({last_error})")
+            time.sleep(delay)
+        offset = start + segment[2]
+        if end is not None and offset > end:
+            return True
+        headers = dict(IDENTITY_ENCODING, Range=f"bytes={offset}-{end}") if ranged else IDENTITY_ENCODING
+        try:
+            response = get_session().get(url, stream=True, allow_redirects=True, headers=headers,
+                                         timeout=request_timeout(url))
+            if ranged and response.status_code != 206:
+                raise requests.RequestException(f"server ignored the byte range (HTTP {response.status_code})")
+            if response.status_code not in (200, 206):
+                raise requests.RequestException(f"HTTP {response.status_code}")
+            if ranged and encoded(response):
+                raise requests.RequestException("server compressed a byte range")
+            if not ranged and segment[2]:
+                # Without ranges we can only start over
+                progress_bar.update(-segment[2])
+                segment[2] = 0
+                offset = start
+                if digest is not None:
+                    digest['sha256'] = hashlib.sha256()
+            with open(part_path, 'r+b') as file:
+                file.seek(offset)
+                written_since_save = 0
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_BLOCK_SIZE):
+                    file.write(chunk)
+                    if digest is not None:
+                        digest['sha256'].update(chunk)
+                    segment[2] += len(chunk)
+                    progress_bar.update(len(chunk))
+                    written_since_save += len(chunk)
+                    if state_path and written_since_save >= 8 * 1024 * 1024:
+                        file.flush()
+                        save_download_state(state_path, state, lock)
+                        written_since_save = 0
+            if end is None or start + segment[2] > end:
+                return True
+            last_error = f"connection closed at byte {start + segment[2]} of {end + 1}"
+        except (requests.RequestException, OSError) as e:
+            last_error = e
+        finally:
+            if state_path:
+                save_download_state(state_path, state, lock)
+    print(f"Failed to download {url}: {last_error}")
+    return False
+
+def download_file(url, dest, sha256=None, size=None, peer=True, record=None):
+    # record, when given, receives the file's validators and sha256 for the lockfile
+    mirrored = peer and peer_url('file', url=url)
+    if mirrored:
+        if download_file(mirrored, dest, sha256, size, peer=False, record=record):
+            if record is not None:
+                # The lockfile compares against upstream, not against the peer's copy
+                record['remote'] = remote_validators(url)
+            return True
+        print(f"The peer could not serve {os.path.basename(dest)}, downloading it from upstream.")
+
+    # Create the directory if it doesn't exist
+    if os.path.dirname(dest) and not os.path.exists(os.path.dirname(dest)):
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+
+    part_path = dest + '.part'
+    state_path = dest + '.part.json'
+    total_size, ranged, validators = probe_download(url)
+    lock = threading.Lock()
+
+    state = load_download_state(state_path, url, total_size, part_path) if ranged else None
+    if state is None:
+        if ranged:
+            connections = DOWNLOAD_SETTINGS['connections'] if total_size >= DOWNLOAD_SETTINGS['min_split_size'] else 1
+            connections = max(1, connections)
+            step = -(-total_size // connections)
+            segments = [[start, min(start + step, total_size) - 1, 0] for start in range(0, total_size, step)]
+        else:
+            segments = [[0, total_size - 1 if total_size else None, 0]]
+        state = {'url': url, 'size': total_size, 'segments': segments}
+        with open(part_path, 'wb') as file:
+            if ranged:
+                file.truncate(total_size)
     else:
+        print(f"Resuming download of {os.path.basename(dest)}")
+
+    from tqdm import tqdm
+    done = sum(segment[2] for segment in state['segments'])
+    progress_bar = tqdm(total=total_size, initial=done, unit='B', unit_scale=True, desc=os.path.basename(dest))
+    segment_args = (part_path, ranged, progress_bar, state_path if ranged else None, state, lock)
+    digest = {'sha256': hashlib.sha256()} if len(state['segments']) == 1 and not done else None
+    try:
+        if len(state['segments']) == 1:
+            results = [download_segment(url, state['segments'][0], *segment_args, digest=digest)]
+        else:
+            with ThreadPoolExecutor(max_workers=len(state['segments'])) as executor:
+                futures = [executor.submit(download_segment, url, segment, *segment_args) for segment in state['segments']]
+                results = [future.result() for future in futures]
+    finally:
+        progress_bar.close()
+        # Counted here, the segments run on threads of their own
+        count('bytes_downloaded', progress_bar.n - done)
+        count('bytes_written', progress_bar.n - done)
+    if not all(results):
+        # Keep the .part file around for ranged downloads so the next run can resume it
+        if not ranged and os.path.exists(part_path):
+            os.remove(part_path)
         print("Failed to download file")
         return False
 
+    actual_size = os.path.getsize(part_path)
+    expected_size = size or total_size
+    if expected_size and actual_size != int(expected_size):
+        print(f"Downloaded {os.path.basename(dest)} is {actual_size} bytes, expected {expected_size}")
+        os.remove(part_path)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        return False
+    actual_sha256 = None
+    if sha256 or record is not None:
+        # Split and resumed downloads are written out of order, only those are read back
+        actual_sha256 = digest['sha256'].hexdigest() if digest else file_sha256(part_path)
+    if sha256 and actual_sha256 != sha256.lower():
+        print(f"Checksum mismatch for {os.path.basename(dest)}")
+        os.remove(part_path)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        return False
+
+    os.replace(part_path, dest)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    if record is not None:
+        record.update(remote=validators, sha256=actual_sha256)
+    return True
+
+class ProgressReader:
+    def __init__(self, raw, progress_bar, copy=None):
+        self.raw = raw
+        self.progress_bar = progress_bar
+        self.copy = copy
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        chunk = self.raw.read(size)
+        self.progress_bar.update(len(chunk))
+        self.digest.update(chunk)
+        if self.copy:
+            self.copy.write(chunk)
+        return chunk
+
+def counted_members(tar_ref):
+    for member in tar_ref:
+        if member.isfile():
+            count('files_written')
+            count('bytes_written', member.size)
+        yield member
+
+def tar_compression(file):
+    for suffix, compression in STREAMABLE_ARCHIVES.items():
+        if file.endswith(suffix):
+            return compression
+    return None
+
+def stream_extract(url, archive_name, dest, archive_copy=None, sha256=None, size=None, record=None):
+    compression = tar_compression(archive_name)
+    if compression is None:
+        return False
+    try:
+        response = peer_get('file', url, headers=IDENTITY_ENCODING)
+        if record is not None:
+            record['remote'] = remote_validators(url) if response else None
+        response = response or get_session().get(url, stream=True, allow_redirects=True, headers=IDENTITY_ENCODING,
+                                                 timeout=DOWNLOAD_TIMEOUT)
+        if response.status_code != 200:
+            print("Failed to download file")
+            return False
+        if record is not None and record['remote'] is None:
+            record['remote'] = response_validators(response)
+        response.raw.decode_content = True
+        from tqdm import tqdm
+        # A server that compresses anyway reports the compressed length, which the decoded stream never reaches
+        total_size = 0 if encoded(response) else int(response.headers.get('content-length', 0))
+        progress_bar = tqdm(total=total_size, unit='B', unit_scale=True, desc=os.path.basename(archive_name))
+        copy = open(archive_copy, 'wb') if archive_copy else None
+        try:
+            reader = ProgressReader(response.raw, progress_bar, copy)
+            process = open_xz_stream(reader) if compression == 'xz' else None
+            if process:
+                extract_xz_stream(process, dest)
+            else:
+                with tarfile.open(fileobj=reader, mode=f"r|{compression}", bufsize=1024 * 1024) as tar_ref:
+                    tar_ref.extractall(dest, members=counted_members(tar_ref))
+            # Drain the end-of-archive padding so the cached copy is byte-for-byte complete
+            while reader.read(1024 * 1024):
+                pass
+        finally:
+            progress_bar.close()
+            count('bytes_downloaded', progress_bar.n)
+            if copy:
+                copy.close()
+        expected_size = int(size or total_size)
+        if expected_size and progress_bar.n != expected_size:
+            print(f"Incomplete download of {url}")
+            return False
+        if sha256 and reader.digest.hexdigest() != sha256.lower():
+            print(f"Checksum mismatch for {os.path.basename(archive_name)}")
+            return False
+        return True
+    except (requests.RequestException, tarfile.TarError, EOFError, OSError) as e:
+        print(f"Streaming extraction of {url} failed: {e}")
+        return False
+
+def system_extractor(*names):
+    if not SYSTEM_EXTRACTORS_ENABLED:
+        return None
+    for name in names:
+        path = shutil.which(name)
+        if path:
+            return path
+    return None
+
+def open_xz_stream(source):
+    # xz decodes multi-block archives on every core, python's lzma module only ever uses one
+    xz = system_extractor('xz')
+    if xz is None:
+        return None
+    if isinstance(source, str):
+        return subprocess.Popen([xz, '-dc', '-T0', source], stdout=subprocess.PIPE)
+    process = subprocess.Popen([xz, '-dc', '-T0'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    process.feed_errors = []
+
+    def feed():
+        try:
+            while True:
+                chunk = source.read(1024 * 1024)
+                if not chunk:
+                    break
+                process.stdin.write(chunk)
+        except BrokenPipeError:
+            pass
+        except Exception as e:
+            process.feed_errors.append(e)
+        finally:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+
+    process.feeder = threading.Thread(target=feed, daemon=True)
+    process.feeder.start()
+    return process
+
+def extract_xz_stream(process, dest):
+    try:
+        with tarfile.open(fileobj=process.stdout, mode='r|', bufsize=1024 * 1024) as tar_ref:
+            tar_ref.extractall(dest, members=counted_members(tar_ref))
+        while process.stdout.read(1024 * 1024):
+            pass
+    finally:
+        process.stdout.close()
+        feeder = getattr(process, 'feeder', None)
+        if feeder:
+            feeder.join()
+        process.wait()
+    feed_errors = getattr(process, 'feed_errors', None)
+    if feed_errors:
+        raise feed_errors[0]
+    if process.returncode != 0:
+        raise tarfile.ReadError(f"xz exited with status {process.returncode}")
+
+def zip_member_path(dest, name):
+    # Same sanitising as ZipFile.extract, so members cannot escape dest
+    name = name.replace('/', os.path.sep)
+    if os.path.altsep:
+        name = name.replace(os.path.altsep, os.path.sep)
+    name = os.path.splitdrive(name)[1]
+    parts = [part for part in name.split(os.path.sep) if part not in ('', os.path.curdir, os.path.pardir)]
+    if os.name == 'nt':
+        parts = [re.sub(r'[:<>|"?*]', '_', part).rstrip('.') for part in parts]
+        parts = [part for part in parts if part]
+    return os.path.join(dest, *parts) if parts else None
+
+def extract_zip_members(file, members):
+    with zipfile.ZipFile(file, 'r') as zip_ref:
+        for info, target in members:
+            with zip_ref.open(info) as source, open(target, 'wb') as target_file:
+                shutil.copyfileobj(source, target_file, 1024 * 1024)
+
+def extract_zip(file, dest, jobs=EXTRACT_JOBS):
+    with zipfile.ZipFile(file, 'r') as zip_ref:
+        members = []
+        for info in zip_ref.infolist():
+            target = zip_member_path(dest, info.filename)
+            if target is None:
+                continue
+            if info.is_dir():
+                os.makedirs(target, exist_ok=True)
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                members.append((info, target))
+    total_size = sum(info.file_size for info, _ in members)
+    count('files_written', len(members))
+    count('bytes_written', total_size)
+    # Small archives are not worth a pool, large ones get a worker per EXTRACT_WORKER_BYTES
+    workers = max(1, min(jobs, len(members), total_size // EXTRACT_WORKER_BYTES))
+    if workers == 1:
+        extract_zip_members(file, members)
+        return workers
+    # Largest members first onto the least loaded worker keeps the buckets even
+    buckets = [[0, []] for _ in range(workers)]
+    for info, target in sorted(members, key=lambda member: member[0].file_size, reverse=True):
+        bucket = min(buckets, key=lambda bucket: bucket[0])
+        bucket[0] += info.file_size
+        bucket[1].append((info, target))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(extract_zip_members, file, bucket[1]) for bucket in buckets]:
+            future.result()
+    return workers
+
+def extract_7z(file, dest):
+    method = extract_7z_archive(file, dest)
+    # Neither extractor reports what it wrote, so count the result
+    for root, _, names in os.walk(dest):
+        count('files_written', len(names))
+        count('bytes_written', sum(os.path.getsize(os.path.join(root, name)) for name in names))
+    return method
+
+def extract_7z_archive(file, dest):
+    seven_zip = system_extractor('7zz', '7z', '7za')
+    if seven_zip:
+        os.makedirs(dest, exist_ok=True)
+        result = subprocess.run([seven_zip, 'x', '-y', '-mmt=on', f"-o{dest}", file],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if result.returncode == 0:
+            return '7z'
+        print(f"{os.path.basename(seven_zip)} failed, falling back to py7zr: {result.stderr.strip()}")
+    import py7zr
+    # mp decodes independent folders of non-solid archives in parallel
+    with py7zr.SevenZipFile(file, mode='r', mp=EXTRACT_JOBS > 1) as zip7_ref:
+        zip7_ref.extractall(path=dest)
+    return 'py7zr'
+
 def extract_archive(file, dest):
-    if file.endswith('.tar.xz'):
-        with tarfile.open(file, 'r:xz') as tar_ref:
-            tar_ref.extractall(dest)
+    start = time.perf_counter()
+    compression = tar_compression(file)
+    if compression is not None:
+        process = open_xz_stream(file) if compression == 'xz' else None
+        if process:
+            extract_xz_stream(process, dest)
+            method = 'xz -T0'
+        else:
+            with tarfile.open(file, f"r:{compression}" if compression else 'r:') as tar_ref:
+                tar_ref.extractall(dest, members=counted_members(tar_ref))
+            method = 'tarfile'
     elif file.endswith('.zip'):
-        with zipfile.ZipFile(file, 'r') as zip_ref:
-            zip_ref.extractall(dest)
+        method = f"zipfile x{extract_zip(file, dest)}"
     elif file.endswith('.7z'):
-        with py7zr.SevenZipFile(file, mode='r') as zip7_ref:
-            zip7_ref.extractall(path=dest)
+        method = extract_7z(file, dest)
     else:
         print("Unsupported archive format")
-        
+        return
+    elapsed = max(time.perf_counter() - start, 1e-6)
+    size = os.path.getsize(file) / (1024 * 1024)
+    print(f"Extracted {os.path.basename(file)} ({method}) in {elapsed:.1f}s, {size / elapsed:.1f} MB/s")
+
 def onerror(func, path, exc_info):
     import stat
     # Is the error an access error?
@@ -61,46 +701,495 @@ def onerror(func, path, exc_info):
     else:
         raise
 
+def copy_file_range(src, dest):
+    # In-kernel copy without bouncing the data through Python, falls back to a plain copy
+    with open(src, 'rb') as src_file, open(dest, 'wb') as dest_file:
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while os.copy_file_range(src_file.fileno(), dest_file.fileno(), 1 << 30):
+                    pass
+                return
+            except OSError:
+                src_file.seek(0)
+                dest_file.seek(0)
+                dest_file.truncate()
+        shutil.copyfileobj(src_file, dest_file, 1024 * 1024)
+
+def clone_file(src, dest):
+    # Prefer a copy-on-write reflink, then an in-kernel copy. Never a hardlink: a later in-place write to
+    # dest, such as an extraction over fxServer, would go through to the cached source
+    devices = None
+    if os.name != 'nt':
+        devices = (os.stat(src).st_dev, os.stat(os.path.dirname(dest) or '.').st_dev)
+    if devices and devices not in reflink_unsupported:
+        try:
+            import fcntl
+            with open(src, 'rb') as src_file, open(dest, 'wb') as dest_file:
+                fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+            shutil.copystat(src, dest)
+            return
+        except OSError:
+            reflink_unsupported.add(devices)
+            if os.path.exists(dest):
+                os.remove(dest)
+    copy_file_range(src, dest)
+    shutil.copystat(src, dest)
+
+def copy_tree(src, dest, replace=False, jobs=COPY_JOBS):
+    # Directories are created up front, the files are then cloned on a thread pool
+    files = []
+    directories = []
+    for root, dirs, names in os.walk(src):
+        dest_root = os.path.normpath(os.path.join(dest, os.path.relpath(root, src)))
+        os.makedirs(dest_root, exist_ok=True)
+        directories.append((root, dest_root))
+        for name in dirs + names:
+            src_path = os.path.join(root, name)
+            dest_path = os.path.join(dest_root, name)
+            is_link = os.path.islink(src_path)
+            if not is_link and name in dirs:
+                continue
+            if replace and os.path.lexists(dest_path):
+                remove_tree(dest_path)
+            if is_link:
+                os.symlink(os.readlink(src_path), dest_path)
+            else:
+                files.append((src_path, dest_path))
+
+    count('files_written', len(files))
+    if len(files) < 16 or jobs <= 1:
+        for src_path, dest_path in files:
+            clone_file(src_path, dest_path)
+    else:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            list(executor.map(lambda item: clone_file(item[0], item[1]), files))
+    for src_root, dest_root in reversed(directories):
+        shutil.copystat(src_root, dest_root)
+
+def clone_tree(src, dest):
+    copy_tree(src, dest, replace=True)
+
+def move_contents(src, dest):
+    # Move every entry of src up into dest with one rename each, then drop the emptied src
+    staging = os.path.join(dest, f".move-{os.getpid()}-{threading.get_ident()}")
+    os.rename(src, staging)
+    for entry in os.scandir(staging):
+        target = os.path.join(dest, entry.name)
+        if os.path.lexists(target):
+            remove_tree(target)
+        os.rename(entry.path, target)
+    remove_tree(staging)
+
+def find_directories(root, name):
+    # scandir based walk that yields every directory called name without descending into it
+    stack = [root]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name == name:
+                        yield entry.path
+                    else:
+                        stack.append(entry.path)
+
+def parallel_rmtree(path):
+    entries = [entry.path for entry in os.scandir(path)]
+    with ThreadPoolExecutor(max_workers=REMOVE_JOBS) as executor:
+        list(executor.map(lambda entry: remove_tree(entry, background=False), entries))
+    shutil.rmtree(path, onerror=onerror)
+
+def remove_tree(path, background=True):
+    global trash_executor
+    if os.path.islink(path) or os.path.isfile(path):
+        os.remove(path)
+        return
+    if not os.path.isdir(path):
+        return
+    if not background:
+        shutil.rmtree(path, onerror=onerror)
+        return
+
+    # Renaming is instant, the actual deletion then happens while the deploy carries on
+    os.makedirs(TRASH_DIR, exist_ok=True)
+    trash = os.path.join(TRASH_DIR, f"{os.path.basename(os.path.normpath(path))}-{os.getpid()}-{time.time_ns()}")
+    try:
+        os.rename(path, trash)
+    except OSError:
+        shutil.rmtree(path, onerror=onerror)
+        return
+    with trash_guard:
+        if trash_executor is None:
+            trash_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='trash')
+        trash_futures.append(trash_executor.submit(parallel_rmtree, trash))
+
+def empty_trash():
+    # Also picks up anything an interrupted run left in the trash
+    if os.path.isdir(TRASH_DIR):
+        for entry in os.scandir(TRASH_DIR):
+            remove_tree(entry.path)
+
+def wait_for_trash():
+    with trash_guard:
+        futures = list(trash_futures)
+        trash_futures.clear()
+    if futures:
+        print("Waiting for background deletions to finish...")
+    for future in futures:
+        try:
+            future.result()
+        except OSError as e:
+            print(f"Background deletion failed: {e}")
+
+def tree_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            file_path = os.path.join(root, file)
+            if not os.path.islink(file_path):
+                total += os.path.getsize(file_path)
+    return total
+
+def artifact_cache_key(artifact_url):
+    match = re.search(r'/(\d+)-([\da-f]+)/', artifact_url)
+    if match:
+        return f"{match.group(1)}-{match.group(2)}"
+    return hashlib.sha256(artifact_url.encode()).hexdigest()
+
+def evict_artifact_cache(keep=None):
+    entries = []
+    for name in os.listdir(ARTIFACT_CACHE_DIR):
+        entry = os.path.join(ARTIFACT_CACHE_DIR, name)
+        meta_path = os.path.join(entry, 'meta.json')
+        if not os.path.exists(meta_path):
+            continue
+        with open(meta_path, 'r') as file:
+            meta = json.load(file)
+        entries.append((os.path.getmtime(entry), entry, meta['size']))
+
+    total = sum(size for _, _, size in entries)
+    for _, entry, size in sorted(entries):
+        if total <= ARTIFACT_CACHE_SIZE:
+            break
+        if entry == keep:
+            continue
+        print(f"Evicting cached artifact {os.path.basename(entry)}")
+        remove_tree(entry)
+        total -= size
+
+def install_artifact(artifact_url, archive_name, dest, stream=True):
+    if ARTIFACT_CACHE_SIZE <= 0:
+        if stream and stream_extract(artifact_url, archive_name, dest):
+            return True
+        if not download_file(artifact_url, archive_name):
+            return False
+        extract_archive(archive_name, dest)
+        return True
+
+    key = artifact_cache_key(artifact_url)
+    entry = os.path.join(ARTIFACT_CACHE_DIR, key)
+    tree = os.path.join(entry, 'tree')
+    if os.path.exists(os.path.join(entry, 'meta.json')):
+        print(f"Using cached artifact {key}")
+        os.utime(entry)
+        clone_tree(tree, dest)
+        return True
+
+    # Build the entry next to its final location and publish it with a single rename
+    staging = f"{entry}.partial-{os.getpid()}"
+    if os.path.exists(staging):
+        shutil.rmtree(staging, onerror=onerror)
+    os.makedirs(staging)
+    archive = os.path.join(staging, archive_name)
+    staging_tree = os.path.join(staging, 'tree')
+    if not (stream and stream_extract(artifact_url, archive_name, staging_tree, archive_copy=archive)):
+        if os.path.exists(staging_tree):
+            shutil.rmtree(staging_tree, onerror=onerror)
+        if not download_file(artifact_url, archive):
+            shutil.rmtree(staging, onerror=onerror)
+            return False
+        extract_archive(archive, staging_tree)
+    with open(os.path.join(staging, 'meta.json'), 'w') as file:
+        json.dump({
+            'url': artifact_url,
+            'archive': archive_name,
+            'size': tree_size(staging),
+            'created': time.time()
+        }, file, indent=2)
+    if os.path.exists(os.path.join(entry, 'meta.json')):
+        # Another process published this build meanwhile and may be cloning from it, keep theirs
+        shutil.rmtree(staging, onerror=onerror)
+    else:
+        if os.path.exists(entry):
+            remove_tree(entry)
+        try:
+            os.rename(staging, entry)
+        except OSError:
+            if not os.path.exists(os.path.join(entry, 'meta.json')):
+                raise
+            shutil.rmtree(staging, onerror=onerror)
+    evict_artifact_cache(keep=entry)
+    clone_tree(tree, dest)
+    return True
+
+def git_output(args):
+    result = subprocess.run(['git'] + args, capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    return result.stdout.strip()
+
+def git_object_count(path):
+    output = git_output(['-C', path, 'count-objects', '-v']) or ''
+    values = dict(line.split(': ', 1) for line in output.splitlines() if ': ' in line)
+    return int(values.get('count', 0)) + int(values.get('in-pack', 0))
+
+def git_mirror_path(src):
+    name = re.sub(r'[^A-Za-z0-9._-]+', '_', src.rstrip('/').split('/')[-1])
+    if name.endswith('.git'):
+        name = name[:-4]
+    return os.path.join(GIT_CACHE_DIR, f"{hashlib.sha256(src.encode()).hexdigest()[:16]}-{name}.git")
+
+def remote_ref_sha(src, ref, peel=False):
+    output = git_output(['ls-remote', src, ref or 'HEAD'])
+    if not output:
+        return None
+    refs = {}
+    for line in output.splitlines():
+        sha, name = line.split('\t', 1)
+        refs[name] = sha
+    if not ref:
+        return refs.get('HEAD')
+    # Match git clone --branch, which prefers a branch over a tag of the same name
+    if peel and f"refs/tags/{ref}^{{}}" in refs and f"refs/heads/{ref}" not in refs:
+        return refs[f"refs/tags/{ref}^{{}}"]
+    return refs.get(f"refs/heads/{ref}") or refs.get(f"refs/tags/{ref}")
+
+def update_git_mirror(src, ref):
+    mirror = git_mirror_path(src)
+    with git_mirror_locks_guard:
+        lock = git_mirror_locks.setdefault(mirror, threading.Lock())
+
+    with lock:
+        if not os.path.exists(os.path.join(mirror, 'HEAD')):
+            staging = f"{mirror}.partial-{os.getpid()}"
+            for source in filter(None, (peer_git_source(src, ref), src)):
+                if os.path.exists(staging):
+                    shutil.rmtree(staging, onerror=onerror)
+                result = subprocess.run(['git', 'clone', '--bare', '--quiet', source, staging])
+                if result.returncode == 0:
+                    break
+            if result.returncode != 0:
+                if os.path.exists(staging):
+                    shutil.rmtree(staging, onerror=onerror)
+                return None
+            # The mirror keeps pointing upstream, the peer is only asked first
+            subprocess.run(['git', '-C', staging, 'remote', 'set-url', 'origin', src])
+            subprocess.run(['git', '-C', staging, 'config', 'remote.origin.fetch', GIT_MIRROR_REFSPECS[0]])
+            subprocess.run(['git', '-C', staging, 'config', '--add', 'remote.origin.fetch', GIT_MIRROR_REFSPECS[1]])
+            count('git_objects', git_object_count(staging))
+            try:
+                os.rename(staging, mirror)
+            except OSError:
+                # Another process (a fleet worker) published the mirror first, use theirs
+                if not os.path.exists(os.path.join(mirror, 'HEAD')):
+                    raise
+                shutil.rmtree(staging, onerror=onerror)
+            return mirror
+
+        local_sha = git_output(['-C', mirror, 'rev-parse', '--verify', '--quiet', ref or 'HEAD'])
+        if local_sha and not git_mirror_refresh:
+            # Workers clone from mirrors their parent process just prefetched, only a missing ref is fetched
+            os.utime(mirror)
+            return mirror
+        # Only fetch when the ref we are about to clone has moved upstream
+        remote_sha = remote_ref_sha(src, ref)
+        if remote_sha and remote_sha != local_sha:
+            objects = git_object_count(mirror)
+            source = peer_git_source(src, ref)
+            if not source or subprocess.run(['git', '-C', mirror, 'fetch', '--prune', '--quiet', source]
+                                            + GIT_MIRROR_REFSPECS).returncode != 0:
+                subprocess.run(['git', '-C', mirror, 'fetch', '--prune', '--quiet', 'origin'] + GIT_MIRROR_REFSPECS)
+            count('git_objects', max(0, git_object_count(mirror) - objects))
+        os.utime(mirror)
+        return mirror
+
+def clone_github(src, ref, dest, shallow=False):
+    branch_args = ['--branch', ref] if ref else []
+    mirror = update_git_mirror(src, ref) if GIT_CACHE_ENABLED else None
+    if mirror:
+        # A local clone hardlinks the mirror's objects, so nothing goes over the network
+        result = subprocess.run(['git', 'clone', '--quiet'] + branch_args + [mirror, dest])
+        if result.returncode == 0:
+            subprocess.run(['git', '-C', dest, 'remote', 'set-url', 'origin', src])
+        return result.returncode == 0
+    depth_args = ['--depth', '1'] if shallow else []
+    result = subprocess.run(['git', 'clone', '--quiet'] + depth_args + branch_args + [src, dest])
+    if result.returncode == 0:
+        count('git_objects', git_object_count(dest))
+    return result.returncode == 0
+
+def git_version():
+    global git_version_info
+    if git_version_info is None:
+        match = re.search(r'(\d+)\.(\d+)', git_output(['--version']) or '')
+        git_version_info = (int(match.group(1)), int(match.group(2))) if match else (0, 0)
+    return git_version_info
+
+def sparse_clone_github(src, ref, dest, subpath, shallow=False):
+    # Check out nothing but subpath and rename it into dest, returns the commit or None to fall back to a full clone
+    subpath = normalize_task_path(subpath)
+    if git_version() < SPARSE_GIT_VERSION or not subpath or subpath.startswith('..'):
+        return None
+    if os.path.isdir(dest) and not os.listdir(dest):
+        os.rmdir(dest)
+    if os.path.lexists(dest):
+        return None
+    branch_args = ['--branch', ref] if ref else []
+    staging = f"{dest}.sparse-{os.getpid()}-{threading.get_ident()}"
+    mirror = update_git_mirror(src, ref) if GIT_CACHE_ENABLED else None
+    if mirror:
+        # The local clone hardlinks the mirror's objects, only the checkout is limited to subpath
+        clone_args = [mirror]
+    else:
+        # Only the blobs under subpath are fetched, lazily by the checkout below
+        clone_args = ['--filter=blob:none'] + (['--depth', '1'] if shallow else []) + [src]
+    try:
+        commands = [
+            ['git', 'clone', '--quiet', '--no-checkout'] + branch_args + clone_args + [staging],
+            ['git', '-C', staging, 'sparse-checkout', 'init', '--cone'],
+            ['git', '-C', staging, 'sparse-checkout', 'set', subpath],
+            ['git', '-C', staging, 'checkout', '--quiet', 'HEAD'],
+        ]
+        for command in commands:
+            if subprocess.run(command).returncode != 0:
+                return None
+        sha = git_output(['-C', staging, 'rev-parse', 'HEAD'])
+        if not mirror:
+            count('git_objects', git_object_count(staging))
+        if not os.path.isdir(os.path.join(staging, subpath)):
+            print(f"{subpath} not found in {src}, cloning the whole repository instead")
+            return None
+        os.makedirs(os.path.dirname(dest) or '.', exist_ok=True)
+        os.rename(os.path.join(staging, subpath), dest)
+        return sha
+    finally:
+        remove_tree(staging)
+
+def file_cache_path(url):
+    name = os.path.basename(url.split('?', 1)[0].rstrip('/')) or 'download'
+    return os.path.join(FILE_CACHE_DIR, f"{hashlib.sha256(url.encode()).hexdigest()[:32]}-{name}")
+
+def response_validators(response):
+    return [response.headers.get(key) for key in ('etag', 'last-modified', 'content-length')]
+
+def remote_validators(url):
+    try:
+        response = get_session().head(url, allow_redirects=True, headers=IDENTITY_ENCODING, timeout=DOWNLOAD_TIMEOUT)
+    except requests.RequestException:
+        return None
+    if response.status_code >= 400:
+        return None
+    return response_validators(response)
+
+def prefetch_file(url, sha256=None, size=None):
+    path = file_cache_path(url)
+    meta_path = path + '.json'
+    remote = remote_validators(url)
+    if os.path.exists(path) and os.path.exists(meta_path):
+        with open(meta_path, 'r') as file:
+            meta = json.load(file)
+        # Keep the cached copy while the server reports the same validators for it
+        if remote is None or remote == meta.get('validators'):
+            if not sha256 or meta.get('sha256') == sha256.lower():
+                return path
+    record = {}
+    if not download_file(url, path, sha256, size, record=record):
+        return None
+    with open(meta_path, 'w') as file:
+        json.dump({'url': url, 'validators': remote, 'sha256': record['sha256']}, file, indent=2)
+    return path
+
+def cached_file_record(path):
+    # The prefetch that filled the file cache already asked upstream for the validators
+    with open(path + '.json', 'r') as file:
+        meta = json.load(file)
+    return {'remote': meta.get('validators'), 'sha256': meta.get('sha256')}
+
 def generate_db_name(recipe):
     name = recipe.get('name').replace(' ', '')
     random_string = ''.join(random.choices(string.hexdigits.upper(), k=6))
     return f"{name}_{random_string}"
 
 # fetch build numbers
+ANCHOR_PATTERN = re.compile(r'<a\s[^>]*?href=["\']([^"\']+)["\'][^>]*>(.*?)</a>', re.S | re.I)
+
+def parse_build_index(file, artifact_url, search_url):
+    # Single pass over the listing, only anchors are looked at and nothing else is kept in memory
+    build_pattern = re.compile(search_url)
+    builds = {}
+    recommended_build = None
+    buffer = ''
+    for chunk in iter(lambda: file.read(64 * 1024), ''):
+        buffer += chunk
+        end = 0
+        for match in ANCHOR_PATTERN.finditer(buffer):
+            end = match.end()
+            href = match.group(1)
+            build_match = build_pattern.search(href)
+            if build_match:
+                build_number = build_match.group(1)
+                builds[build_number] = artifact_url + href
+                if 'LATEST RECOMMENDED' in match.group(2):
+                    recommended_build = build_number
+        # Carry an anchor that is split across two chunks over to the next one
+        start = buffer.find('<a', end)
+        if start != -1:
+            buffer = buffer[start:]
+        else:
+            buffer = '<' if buffer.endswith('<') else ''
+    return builds, recommended_build
+
 def fetch_build_numbers():
-    artifact_url = 'https://runtime.fivem.net/artifacts/fivem/build_server_windows/master/' if os.name == 'nt' else 'https://runtime.fivem.net/artifacts/fivem/build_proot_linux/master/'
+    artifact_url = ARTIFACTS_URL
     if os.name == 'nt':
         search_url = r'(\d+)-[\da-f]+/server\.7z'
     else:
         search_url = r'(\d+)-[\da-f]+/fx\.tar\.xz'
 
-    response = requests.get(artifact_url)
-    response.raise_for_status()
-
-    soup = BeautifulSoup(response.text, 'html.parser')
-    builds = {}
-    recommended_build = None
+    body_path, changed = cached_get(artifact_url)
+    parsed_path = body_path + '.builds.json'
+    if not changed and os.path.exists(parsed_path):
+        with open(parsed_path, 'r') as file:
+            parsed = json.load(file)
+        return parsed['builds'], parsed['recommended']
 
-    for link in soup.find_all('a', href=True):
-        href = link['href']
-        match = re.search(search_url, href)
-        if match:
-            build_number = match.group(1)
-            builds[build_number] = artifact_url + href
-            if 'LATEST RECOMMENDED' in link.text:
-                recommended_build = build_number
+    with open(body_path, 'r', encoding='utf-8') as file:
+        builds, recommended_build = parse_build_index(file, artifact_url, search_url)
 
+    with open(parsed_path, 'w') as file:
+        json.dump({'builds': builds, 'recommended': recommended_build}, file)
     return builds, recommended_build
 
 def fetch_recipes():
-    recipes_url = 'https://raw.githubusercontent.com/solareon/fxserver-recipes/main/index.json'
-    response = requests.get(recipes_url)
-    response.raise_for_status()
-    return response.json()
+    body_path, _ = cached_get(RECIPES_INDEX_URL)
+    with open(body_path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+def sql_connect(**settings):
+    import mysql.connector
+    if sql_pool_size:
+        # One pool per set of connection settings, kept for the life of the process
+        key = hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()[:16]
+        settings = dict(settings, pool_name=f"fxdeploy-{key}", pool_size=sql_pool_size)
+    return mysql.connector.connect(**settings)
 
 def validate_sql_connection(sql_info):
+    from mysql.connector import Error
     try:
-        connection = mysql.connector.connect(
+        connection = sql_connect(
             host=sql_info['ip'],
             port=sql_info['port'],
             user=sql_info['user'],
@@ -128,9 +1217,12 @@ def validate_sql_connection(sql_info):
                 cursor.execute("FLUSH PRIVILEGES")
                 db_connection_string = f"mysql://{sql_info['db']}:{user_password}@{sql_info['ip']}:{sql_info['port']}/{sql_info['db']}"
                 print(f"Database {sql_info['db']} created successfully.")
+                cursor.close()
+                connection.close()
                 return True, db_connection_string
             elif not db_exists:
                 print(f"Database {sql_info['db']} does not exist. Exiting.")
+                connection.close()
                 return False
                 
             cursor.close()
@@ -143,8 +1235,9 @@ def validate_sql_connection(sql_info):
         return False
 
 def connect_database(sql_info):
+    from mysql.connector import Error
     try:
-        connection = mysql.connector.connect(
+        connection = sql_connect(
             host=sql_info['ip'],
             port=sql_info['port'],
             user=sql_info['user'],
@@ -160,7 +1253,163 @@ def connect_database(sql_info):
         print("Error while connecting to database", e)
         return None
 
-def prompt_user(builds, recommended_build):
+# sql import
+SQL_TOKEN_PATTERN = re.compile(r"['\"`]|--|#|/\*")
+SQL_QUOTE_PATTERNS = {
+    "'": re.compile(r"[\\']"),
+    '"': re.compile(r'[\\"]'),
+    '`': re.compile(r'`'),
+}
+
+def split_sql_statements(lines):
+    # Yields one statement at a time, honouring quotes, comments and mysql client DELIMITER lines
+    delimiter = ';'
+    statement = []
+    state = None
+    for line in lines:
+        directive = line.strip()
+        if state is None and directive[:10].upper() == 'DELIMITER ' and not ''.join(statement).strip():
+            if len(directive.split()) == 2:
+                delimiter = directive.split()[1]
+                statement = []
+                continue
+
+        position = 0
+        delimiter_at = -1
+        while position < len(line):
+            if state in SQL_QUOTE_PATTERNS:
+                quote = state
+                index = position
+                while True:
+                    match = SQL_QUOTE_PATTERNS[quote].search(line, index)
+                    if match is None:
+                        index = len(line)
+                        break
+                    if match.group() == '\\' or line[match.end():match.end() + 1] == quote:
+                        # Skip an escaped character or a doubled quote
+                        index = match.end() + 1
+                    else:
+                        state = None
+                        index = match.end()
+                        break
+                statement.append(line[position:index])
+                position = index
+            elif state in ('/*', '/*!'):
+                end = line.find('*/', position)
+                stop = len(line) if end == -1 else end + 2
+                # /*! ... */ is executable by mysql, plain comments are dropped
+                if state == '/*!':
+                    statement.append(line[position:stop])
+                if end != -1:
+                    state = None
+                position = stop
+            else:
+                token = SQL_TOKEN_PATTERN.search(line, position)
+                if delimiter_at < position:
+                    delimiter_at = line.find(delimiter, position)
+                    if delimiter_at == -1:
+                        delimiter_at = len(line)
+                if delimiter_at < len(line) and (token is None or delimiter_at < token.start()):
+                    statement.append(line[position:delimiter_at])
+                    text = ''.join(statement).strip()
+                    if text:
+                        yield text
+                    statement = []
+                    position = delimiter_at + len(delimiter)
+                    continue
+                if token is None:
+                    statement.append(line[position:])
+                    break
+                statement.append(line[position:token.start()])
+                value = token.group()
+                if value == '--' and line[token.end():token.end() + 1] not in ('', ' ', '\t', '\r', '\n'):
+                    statement.append(value)
+                    position = token.end()
+                elif value in ('--', '#'):
+                    statement.append('\n')
+                    break
+                elif value == '/*':
+                    state = '/*!' if line[token.end():token.end() + 1] in ('!', '+') else '/*'
+                    if state == '/*!':
+                        statement.append(value)
+                    position = token.end()
+                else:
+                    state = value
+                    statement.append(value)
+                    position = token.end()
+
+    text = ''.join(statement).strip()
+    if text:
+        yield text
+
+def read_sql_lines(path, progress_bar):
+    with open(path, 'rb') as file:
+        for raw_line in file:
+            progress_bar.update(len(raw_line))
+            yield raw_line.decode('utf-8', errors='replace')
+
+def import_sql(connection, lines, name, progress_bar=None, session=None, batch_size=SQL_BATCH_SIZE):
+    from mysql.connector import Error
+    cursor = connection.cursor()
+    session = session or {}
+    for key, value in session.items():
+        if not re.fullmatch(r'[a-z_]+', key):
+            print(f"Ignoring invalid session variable: {key}")
+        elif not isinstance(value, (bool, int, float, str)):
+            print(f"Ignoring session variable {key}, its value must be a number or a string")
+    session = {key: value for key, value in session.items()
+               if re.fullmatch(r'[a-z_]+', key) and isinstance(value, (bool, int, float, str))}
+
+    executed = 0
+    start = time.perf_counter()
+    try:
+        for key, value in session.items():
+            # Passed as a parameter, so values such as sql_mode: '' or time_zone: '+00:00' are quoted
+            cursor.execute(f"SET SESSION {key} = %s", (value,))
+        connection.start_transaction()
+        for statement in split_sql_statements(lines):
+            cursor.execute(statement)
+            if cursor.with_rows:
+                cursor.fetchall()
+            executed += 1
+            if executed % batch_size == 0:
+                connection.commit()
+                connection.start_transaction()
+        connection.commit()
+    except Error as e:
+        connection.rollback()
+        print(f"Failed to import {name} at statement {executed + 1}: {e}")
+        return False
+    finally:
+        count('sql_statements', executed)
+        if progress_bar:
+            progress_bar.close()
+        try:
+            for key in session:
+                cursor.execute(f"SET SESSION {key} = DEFAULT")
+            cursor.close()
+        except Error:
+            pass
+
+    elapsed = max(time.perf_counter() - start, 1e-6)
+    print(f"Imported {name}: {executed} statements in {elapsed:.1f}s ({executed / elapsed:.0f} statements/s)")
+    return True
+
+def get_recipe_connection(context):
+    # The database is validated next to the recipe, SQL tasks are the first ones that have to wait for it
+    sql_ready = context.get('sql_ready')
+    if sql_ready is not None and not sql_ready.result():
+        return None
+    # One connection is shared by every SQL task of a recipe
+    connection = context.get('db_connection')
+    if connection is not None and connection.is_connected():
+        return connection
+    connection = connect_database(context['sql_info'])
+    context['db_connection'] = connection
+    return connection
+
+def prompt_user(builds, recommended_build, update=False):
+    import pyinputplus as pyip
     print(f"Recommended build number: \033[92m{recommended_build}\033[0m")
     build_number = pyip.inputStr("Enter the server artifact build number (blank for recommended): ", default=recommended_build,
         applyFunc=lambda x: x.strip() if x else recommended_build)
@@ -187,7 +1436,8 @@ def prompt_user(builds, recommended_build):
             return None
         recipe_url = selected_recipe['url']
     
-    download_file(recipe_url, 'recipe.yaml')
+    if not fetch_cached_file(recipe_url, 'recipe.yaml'):
+        return None
     with open('recipe.yaml', 'r') as file:
         recipe = yaml.safe_load(file)
         
@@ -227,10 +1477,12 @@ def prompt_user(builds, recommended_build):
     
     deploy_path = os.path.join('fxServer', 'txData', deploy_folder)
     
-    if os.path.exists(deploy_path):
+    if os.path.exists(deploy_path) and update:
+        print(f"Updating existing folder {deploy_folder} in place.")
+    elif os.path.exists(deploy_path):
         remove_folder = input(f"Folder {deploy_folder} already exists. Remove it? (y/n): ").strip()
         if remove_folder.lower() == 'y':
-            shutil.rmtree(deploy_path, onerror=onerror)
+            remove_tree(deploy_path)
         else:
             print("Exiting.")
             return None
@@ -260,111 +1512,445 @@ def prompt_user(builds, recommended_build):
         "recipe_description": recipe_description
     }, recipe
 
-def replace_monitor_folder(dest):
-    txadmin_latest_url = "https://github.com/tabarra/txAdmin/releases/latest/download/monitor.zip"
-    download_file(txadmin_latest_url, 'txAdmin.zip')
-    extract_archive('txAdmin.zip', 'txAdmin')
-    monitor_src = 'txAdmin'
+def fetch_monitor():
+    # Revalidated with the release's ETag, so monitor.zip is only downloaded again when a new release is out
+    monitor_zip, _ = cached_get(TXADMIN_URL)
+    return monitor_zip
+
+def monitor_folder(dest):
     if os.name == 'nt':
-        monitor_dest = os.path.join(dest, 'citizen', 'system_resources', 'monitor')
-    else:
-        monitor_dest = os.path.join(dest, 'alpine', 'opt', 'cfx-server', 'citizen', 'system_resources', 'monitor')
+        return os.path.join(dest, 'citizen', 'system_resources', 'monitor')
+    return os.path.join(dest, 'alpine', 'opt', 'cfx-server', 'citizen', 'system_resources', 'monitor')
 
-    if os.path.exists(monitor_dest):
-        shutil.rmtree(monitor_dest, onerror=onerror)
+def replace_monitor_folder(dest, monitor_zip=None):
+    monitor_zip = monitor_zip or fetch_monitor()
+    monitor_dest = monitor_folder(dest)
 
-    shutil.copytree(monitor_src, monitor_dest)
-    shutil.rmtree('txAdmin', onerror=onerror)
-    os.remove('txAdmin.zip')
+    remove_tree(monitor_dest)
 
-def process_recipe(recipe, deploy_folder, sql_info):
-    recipe_dest = os.path.join('fxServer', 'txData', deploy_folder)
-    os.makedirs(recipe_dest, exist_ok=True)
-    
-    for task in recipe['tasks']:
-        action = task['action']
-        keys = ', '.join([f"\033[94m{key}:\033[0m {task.get(key, None)}" for key in task.keys() if key != 'action'])
-        print(f"\033[92mProcessing task\033[0m: {action} ({keys})")
-        if action == 'download_github':
-            src = task['src']
-            ref = task.get('ref', None)
-            dest = os.path.join(recipe_dest, task['dest'])
-            result = subprocess.run(['git', 'clone', '--quiet', '--branch', ref, src, dest]) if ref else subprocess.run(['git', 'clone', '--quiet', src, dest])
-            if result.returncode != 0:
-                print(f"Failed to execute task: {task}")
-                continue
+    # Extract straight into place, there is no intermediate txAdmin folder to copy from
+    extract_archive(monitor_zip, monitor_dest)
+
+SQL_RESOURCE = ':database:'
+DEFAULT_JOBS = 8
+
+TRACED_TASK_KEYS = ('src', 'ref', 'subpath', 'dest', 'path', 'file', 'url')
+
+def run_task(task, context):
+    target = task.get('dest') or task.get('path') or task.get('file') or ''
+    args = {key: str(task[key]) for key in TRACED_TASK_KEYS if key in task}
+    with trace_span(f"{task['action']} {target}".strip(), 'task', **args):
+        return run_action(task, context)
 
-            subpath = task.get('subpath')
+def run_action(task, context):
+    recipe_dest = context['recipe_dest']
+    action = task['action']
+    keys = ', '.join([f"\033[94m{key}:\033[0m {task.get(key, None)}" for key in task.keys() if key != 'action'])
+    print(f"\033[92mProcessing task\033[0m: {action} ({keys})")
+    if action == 'download_github':
+        src = task['src']
+        ref = task.get('ref', None)
+        dest = os.path.join(recipe_dest, task['dest'])
+        subpath = task.get('subpath')
+        sha = sparse_clone_github(src, ref, dest, subpath, shallow=context['shallow_clones']) if subpath else None
+        if sha is None:
+            if not clone_github(src, ref, dest, shallow=context['shallow_clones']):
+                print(f"Failed to execute task: {task}")
+                return False
+            sha = git_output(['-C', dest, 'rev-parse', 'HEAD'])
+            # Fallback for git versions without sparse-checkout: full clone, then move the subpath up
             if subpath:
                 subpath_dest = os.path.join(dest, subpath)
                 if os.path.exists(subpath_dest):
-                    for root, dirs, files in os.walk(subpath_dest):
-                        for file in files:
-                            shutil.move(os.path.join(root, file), os.path.join(dest, file))
-                        for dir in dirs:
-                            shutil.move(os.path.join(root, dir), os.path.join(dest, dir))
-                    shutil.rmtree(subpath_dest, onerror=onerror)
-        elif action == 'move_path':
-            shutil.move(os.path.join(recipe_dest, task['src']), os.path.join(recipe_dest, task['dest']))
-        elif action == 'copy_path':
-            src = os.path.join(recipe_dest, task['src'])
-            dest = os.path.join(recipe_dest, task['dest'])
-            if not os.path.exists(os.path.dirname(dest)):
-                os.makedirs(os.path.dirname(dest), exist_ok=True)
-            overwrite = task.get('overwrite', False)
-            if overwrite and os.path.exists(dest):
-                if os.path.isfile(dest):
-                    os.remove(dest)
-                elif os.path.isdir(dest):
-                    shutil.rmtree(dest, onerror=onerror)
-            if not overwrite and os.path.exists(dest):
-                print(f"Skipping task: Destination path already exists: {dest}")
-                continue
-            if os.path.isfile(src):
-                shutil.copy(src, dest)
-            elif os.path.isdir(src):
-                shutil.copytree(src, dest)
-        elif action == 'download_file':
-            download_file(task['url'], os.path.join(recipe_dest, task['path']))
-        elif action == 'unzip':
-            extract_archive(os.path.join(recipe_dest, task['src']), os.path.join(recipe_dest, task['dest']))
-        elif action == 'remove_path':
-            shutil.rmtree(os.path.join(recipe_dest, task['path']), onerror=onerror)
-        elif action == 'connect_database':
-            db_connection = connect_database(sql_info)
-            if not db_connection:
-                print("Failed to connect to database. Exiting.")
-                return
-        elif action == 'query_database':
-            file = task.get('file')
-            query = task.get('query')
-            if not file and not query:
-                print("Skipping task: No file or query provided.")
+                    move_contents(subpath_dest, dest)
+        context['records'][id(task)] = {'sha': sha}
+    elif action == 'move_path':
+        shutil.move(os.path.join(recipe_dest, task['src']), os.path.join(recipe_dest, task['dest']))
+    elif action == 'copy_path':
+        src = os.path.join(recipe_dest, task['src'])
+        dest = os.path.join(recipe_dest, task['dest'])
+        if not os.path.exists(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+        overwrite = task.get('overwrite', False)
+        if overwrite and os.path.exists(dest):
+            remove_tree(dest)
+        if not overwrite and os.path.exists(dest):
+            print(f"Skipping task: Destination path already exists: {dest}")
+            return True
+        if os.path.isfile(src):
+            if os.path.isdir(dest):
+                dest = os.path.join(dest, os.path.basename(src))
+            clone_file(src, dest)
+        elif os.path.isdir(src):
+            copy_tree(src, dest)
+    elif action == 'download_file':
+        path = os.path.join(recipe_dest, task['path'])
+        cached = file_cache_path(task['url'])
+        record = {}
+        if context['file_cache'] and os.path.exists(cached + '.json'):
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            clone_file(cached, path)
+            record = cached_file_record(cached)
+        elif not download_file(task['url'], path, task.get('sha256'), task.get('size'), record=record):
+            print(f"Failed to execute task: {task}")
+            return False
+        context['records'][id(task)] = record
+    elif action == 'unzip':
+        extract_archive(os.path.join(recipe_dest, task['src']), os.path.join(recipe_dest, task['dest']))
+    elif action == 'download_extract':
+        archive = os.path.join(recipe_dest, task['path'])
+        dest = os.path.join(recipe_dest, task['dest'])
+        checks = (task.get('sha256'), task.get('size'))
+        cached = file_cache_path(task['url'])
+        record = {}
+        if context['file_cache'] and os.path.exists(cached + '.json'):
+            extract_archive(cached, dest)
+            record = cached_file_record(cached)
+        elif not stream_extract(task['url'], archive, dest, None, *checks, record=record):
+            if not download_file(task['url'], archive, *checks, record=record):
+                print(f"Failed to execute task: {task}")
+                return False
+            extract_archive(archive, dest)
+        context['records'][id(task)] = {'remote': record.get('remote')}
+    elif action == 'remove_path':
+        remove_tree(os.path.join(recipe_dest, task['path']))
+    elif action == 'connect_database':
+        if not get_recipe_connection(context):
+            print("Failed to connect to database. Exiting.")
+            return False
+    elif action == 'query_database':
+        from tqdm import tqdm
+        file = task.get('file')
+        query = task.get('query')
+        if not file and not query:
+            print("Skipping task: No file or query provided.")
+            return True
+        db_connection = get_recipe_connection(context)
+        if not db_connection:
+            print("Failed to connect to database. Exiting.")
+            return False
+        session = dict(context.get('sql_session') or {}, **task.get('session', {}))
+        batch_size = task.get('batch_size', SQL_BATCH_SIZE)
+        if file:
+            path = os.path.join(recipe_dest, file)
+            progress_bar = tqdm(total=os.path.getsize(path), unit='B', unit_scale=True, desc=os.path.basename(path))
+            imported = import_sql(db_connection, read_sql_lines(path, progress_bar), file, progress_bar, session, batch_size)
+        else:
+            imported = import_sql(db_connection, query.splitlines(keepends=True), 'query', None, session, batch_size)
+        if not imported:
+            return False
+    elif action == 'ensure_dir':
+        os.makedirs(os.path.join(recipe_dest, task['path']), exist_ok=True)
+    elif action == 'write_file':
+        file_path = os.path.join(recipe_dest, task['file'])
+        append = task.get('append', False)
+        with open(file_path, 'a' if append else 'w') as f:
+            f.write(task['data'])
+        count('files_written')
+        count('bytes_written', len(task['data']))
+    elif action == 'remove_git':
+        for git_dir in list(find_directories(recipe_dest, '.git')):
+            remove_tree(git_dir)
+    else:
+        print(f"Skipping unsupported action: {task['action']}")
+    return True
+
+def task_paths(task):
+    action = task['action']
+    if action == 'download_github':
+        paths = [task['dest']]
+    elif action in ('move_path', 'copy_path', 'unzip'):
+        paths = [task['src'], task['dest']]
+    elif action == 'download_extract':
+        paths = [task['path'], task['dest']]
+    elif action in ('download_file', 'remove_path', 'ensure_dir'):
+        paths = [task['path']]
+    elif action == 'write_file':
+        paths = [task['file']]
+    elif action == 'connect_database':
+        paths = [SQL_RESOURCE]
+    elif action == 'query_database':
+        paths = [SQL_RESOURCE] + ([task['file']] if task.get('file') else [])
+    else:
+        # remove_git and unknown actions may touch anything, so they act as a barrier
+        return ['']
+    return [normalize_task_path(path) for path in paths]
+
+def normalize_task_path(path):
+    path = os.path.normpath(path).replace('\\', '/').strip('/')
+    return '' if path == '.' else path
+
+def paths_overlap(a, b):
+    return a == '' or b == '' or a == b or a.startswith(b + '/') or b.startswith(a + '/')
+
+def fuse_streaming_tasks(tasks):
+    # Turn download_file + unzip pairs of tar archives into one streamed download_extract task
+    fused = list(tasks)
+    task_path_list = [task_paths(task) for task in tasks]
+    for index, task in enumerate(tasks):
+        if task['action'] != 'download_file' or tar_compression(task['path']) is None:
+            continue
+        path = task_path_list[index][0]
+        users = [
+            later for later in range(index + 1, len(tasks))
+            if task_path_list[later] != [''] and any(paths_overlap(path, other) for other in task_path_list[later])
+        ]
+        if not users or tasks[users[0]]['action'] != 'unzip' or task_path_list[users[0]][0] != path:
+            continue
+        # Nothing but a cleanup may look at the archive once it has been extracted
+        if any(tasks[later]['action'] != 'remove_path' and any(other == path or other.startswith(path + '/')
+               for other in task_path_list[later]) for later in users[1:]):
+            continue
+        unzip_index = users[0]
+        fused[unzip_index] = {
+            'action': 'download_extract',
+            'url': task['url'],
+            'path': task['path'],
+            'dest': tasks[unzip_index]['dest']
+        }
+        for key in ('sha256', 'size'):
+            if key in task:
+                fused[unzip_index][key] = task[key]
+        fused[index] = None
+    return [task for task in fused if task is not None]
+
+def build_task_graph(tasks):
+    # A task depends on every earlier task that touches the same path or one of its parents/children
+    task_path_list = [task_paths(task) for task in tasks]
+    dependencies = []
+    for index, paths in enumerate(task_path_list):
+        dependencies.append({
+            earlier for earlier in range(index)
+            if any(paths_overlap(a, b) for a in paths for b in task_path_list[earlier])
+        })
+    return dependencies
+
+def run_task_graph(tasks, dependencies, context, jobs):
+    pending = set(range(len(tasks)))
+    done = set()
+    running = {}
+    failed = False
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            if not failed:
+                for index in sorted(pending):
+                    if dependencies[index] <= done:
+                        pending.discard(index)
+                        running[executor.submit(run_task, tasks[index], context)] = index
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                index = running.pop(future)
+                if future.result():
+                    done.add(index)
+                else:
+                    failed = True
+    return not failed
+
+# lockfile and incremental updates
+LOCKFILE_NAME = 'deploy.lock.json'
+SQL_ACTIONS = ('connect_database', 'query_database')
+
+def task_keys(tasks):
+    # Tasks are matched between deploys by their definition, so inserting a task does not shift the others
+    keys = []
+    seen = {}
+    for task in tasks:
+        spec = hashlib.sha256(json.dumps(task, sort_keys=True, default=str).encode()).hexdigest()[:16]
+        seen[spec] = seen.get(spec, 0) + 1
+        keys.append(f"{spec}:{seen[spec]}")
+    return keys
+
+def task_outputs(task):
+    action = task['action']
+    if action in ('download_github', 'move_path', 'copy_path', 'unzip', 'download_extract'):
+        return [task['dest']]
+    if action in ('download_file', 'ensure_dir'):
+        return [task['path']]
+    if action == 'write_file':
+        return [task['file']]
+    return []
+
+def task_inputs(task):
+    action = task['action']
+    if action in ('move_path', 'copy_path', 'unzip'):
+        return [task['src']]
+    if action == 'write_file' and task.get('append'):
+        return [task['file']]
+    return []
+
+def path_fingerprint(path):
+    if not os.path.lexists(path):
+        return None
+    digest = hashlib.sha256()
+    if os.path.isdir(path) and not os.path.islink(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                stat = os.lstat(os.path.join(root, name))
+                digest.update(f"{os.path.relpath(os.path.join(root, name), path)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    else:
+        stat = os.lstat(path)
+        digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()[:16]
+
+def load_lockfile(recipe_dest):
+    lock_path = os.path.join(recipe_dest, LOCKFILE_NAME)
+    if not os.path.exists(lock_path):
+        return None
+    with open(lock_path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+def write_lockfile(recipe_dest, manifest, tasks, records, previous=None):
+    previous_tasks = {record['key']: record for record in (previous or {}).get('tasks', [])}
+    entries = []
+    for key, task in zip(task_keys(tasks), tasks):
+        record = {'key': key, 'task': task}
+        if id(task) in records:
+            record.update(records[id(task)])
+        elif key in previous_tasks:
+            record.update({name: value for name, value in previous_tasks[key].items() if name not in ('key', 'task', 'outputs')})
+        record['outputs'] = {output: path_fingerprint(os.path.join(recipe_dest, output)) for output in task_outputs(task)}
+        entries.append(record)
+
+    lock = dict(manifest, version=1, updated=time.time(), tasks=entries)
+    if previous and previous.get('templates'):
+        lock['templates'] = previous['templates']
+    with open(os.path.join(recipe_dest, LOCKFILE_NAME), 'w', encoding='utf-8') as file:
+        json.dump(lock, file, indent=2)
+
+def record_template(recipe_dest, name, template):
+    # Keep the unrendered file, an image of this deployment renders it again for every server stamped from it
+    lock = load_lockfile(recipe_dest)
+    if lock is None or '{{' not in template:
+        return
+    lock.setdefault('templates', {})[name] = template
+    with open(os.path.join(recipe_dest, LOCKFILE_NAME), 'w', encoding='utf-8') as file:
+        json.dump(lock, file, indent=2)
+
+def consumed_outputs(tasks, index):
+    # Outputs a later move_path or remove_path takes away are expected to be gone when the lockfile is written
+    later = [normalize_task_path(task['src'] if task['action'] == 'move_path' else task['path'])
+             for task in tasks[index + 1:] if task['action'] in ('move_path', 'remove_path')]
+    return {output for output in task_outputs(tasks[index])
+            if any(paths_overlap(normalize_task_path(output), path) for path in later)}
+
+def task_changed(task, record, recipe_dest, consumed=()):
+    if record is None:
+        return "new or changed task"
+    for output, fingerprint in record.get('outputs', {}).items():
+        if fingerprint is None and output not in consumed:
+            return f"{output} was never produced"
+        if fingerprint is not None and not os.path.lexists(os.path.join(recipe_dest, output)):
+            return f"{output} is missing"
+    if task['action'] == 'download_github' and not record.get('sha'):
+        return "no commit recorded"
+    if task['action'] == 'download_github':
+        sha = remote_ref_sha(task['src'], task.get('ref'), peel=True)
+        if sha and sha != record['sha']:
+            return f"{task.get('ref') or 'HEAD'} moved to {sha[:10]}"
+    if task['action'] in ('download_file', 'download_extract') and record.get('remote'):
+        remote = remote_validators(task['url'])
+        if remote and remote != record['remote']:
+            return "remote file changed"
+    return None
+
+def plan_update(tasks, lock, recipe_dest, jobs):
+    records = {record['key']: record for record in lock.get('tasks', [])}
+    keys = task_keys(tasks)
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        reasons = list(executor.map(lambda index: task_changed(tasks[index], records.get(keys[index]), recipe_dest,
+                                                               consumed_outputs(tasks, index)), range(len(tasks))))
+
+    dirty = {index for index, reason in enumerate(reasons) if reason and tasks[index]['action'] not in SQL_ACTIONS}
+    for index, reason in enumerate(reasons):
+        if index in dirty:
+            print(f"Updating task {index + 1} ({tasks[index]['action']}): {reason}")
+        elif reason:
+            print(f"Skipping database task {index + 1} on update: {reason}")
+
+    dependencies = build_task_graph(tasks)
+    changed = True
+    while changed:
+        changed = False
+        for index in range(len(tasks)):
+            if tasks[index]['action'] in SQL_ACTIONS:
                 continue
-            if file:
-                with open(os.path.join(recipe_dest, file), 'r') as query_file:
-                    query = query_file.read()
-            db_connection = connect_database(sql_info)
-            db_connection.cursor().execute(query, multi=True)
-        elif action == 'ensure_dir':
-            os.makedirs(os.path.join(recipe_dest, task['path']), exist_ok=True)
-        elif action == 'write_file':
-            file_path = os.path.join(recipe_dest, task['file'])
-            append = task.get('append', False)
-            with open(file_path, 'a' if append else 'w') as f:
-                f.write(task['data'])
-        elif action == 'remove_git':
-            for root, dirs, files in os.walk(recipe_dest):
-                for dir in dirs:
-                    if dir == '.git':
-                        shutil.rmtree(os.path.join(root, dir), onerror=onerror)
+            if index in dirty:
+                # A re-run needs whatever produced its inputs to run again first
+                inputs = [normalize_task_path(path) for path in task_inputs(tasks[index])]
+                for earlier in dependencies[index]:
+                    outputs = [normalize_task_path(path) for path in task_outputs(tasks[earlier])]
+                    if earlier not in dirty and tasks[earlier]['action'] not in SQL_ACTIONS and any(
+                            paths_overlap(source, output) for source in inputs for output in outputs):
+                        dirty.add(earlier)
+                        changed = True
+            elif tasks[index]['action'] != 'remove_git' and any(
+                    earlier in dirty and tasks[earlier]['action'] != 'remove_git' for earlier in dependencies[index]):
+                # Downstream of a re-run task; remove_git is a cleanup that never invalidates anything
+                dirty.add(index)
+                changed = True
+            elif tasks[index]['action'] == 'remove_git' and dirty:
+                dirty.add(index)
+                changed = True
+    return dirty
+
+def prepare_rerun(task, recipe_dest):
+    # Clear what the previous deploy left behind so the task can run as if for the first time
+    if task['action'] not in ('download_github', 'download_file', 'move_path', 'copy_path'):
+        return
+    remove_tree(os.path.join(recipe_dest, task['dest'] if 'dest' in task else task['path']))
+
+def process_recipe(recipe, deploy_folder, sql_info, jobs=1, stream=True, sql_session=None, file_cache=False,
+                   manifest=None, update=False, sql_ready=None):
+    recipe_dest = os.path.join('fxServer', 'txData', deploy_folder)
+    os.makedirs(recipe_dest, exist_ok=True)
+    context = {
+        'recipe_dest': recipe_dest,
+        'sql_info': sql_info,
+        'sql_ready': sql_ready,
+        # History is thrown away by remove_git, so there is no point in fetching it
+        'shallow_clones': any(task['action'] == 'remove_git' for task in recipe['tasks']),
+        'sql_session': sql_session,
+        'file_cache': file_cache,
+        'db_connection': None,
+        'records': {}
+    }
+
+    tasks = fuse_streaming_tasks(recipe['tasks']) if stream else recipe['tasks']
+    lock = load_lockfile(recipe_dest) if update else None
+    run_tasks = tasks
+    if update and lock is None:
+        print(f"No {LOCKFILE_NAME} found in {recipe_dest}, running every task.")
+    elif update:
+        dirty = plan_update(tasks, lock, recipe_dest, jobs)
+        print(f"{len(dirty)} of {len(tasks)} tasks need to run again.")
+        run_tasks = [task for index, task in enumerate(tasks) if index in dirty]
+        for task in run_tasks:
+            prepare_rerun(task, recipe_dest)
+
+    try:
+        if jobs <= 1:
+            for task in run_tasks:
+                if not run_task(task, context):
+                    return False
+            succeeded = True
         else:
-            print(f"Skipping unsupported action: {task['action']}")
+            succeeded = run_task_graph(run_tasks, build_task_graph(run_tasks), context, jobs)
+    finally:
+        if context['db_connection'] is not None:
+            context['db_connection'].close()
+
+    if succeeded and manifest is not None:
+        write_lockfile(recipe_dest, manifest, tasks, context['records'], previous=lock)
+    return succeeded
 
 def update_server_cfg(deploy_folder, server_config):
     server_cfg_path = os.path.join('fxServer', 'txData', deploy_folder, 'server.cfg')
     with open(server_cfg_path, 'r') as file:
         server_cfg = file.read()
+    template = server_cfg
     
     # Replace serverEndpoints with connection endpoints
     server_endpoints = [
@@ -384,9 +1970,10 @@ def update_server_cfg(deploy_folder, server_config):
     # Replace the server.cfg file
     with open(server_cfg_path, 'w') as file:
         file.write(server_cfg)
+    return template
 
-def create_txadmin_config(server_config, deploy_folder):
-    json_path = os.path.join('fxServer', 'txData', 'default')
+def create_txadmin_config(server_config, deploy_folder, profile='default'):
+    json_path = os.path.join('fxServer', 'txData', profile)
     current_dir = os.getcwd()
     deploy_path = os.path.join(current_dir, 'fxServer', 'txData', deploy_folder)
     os.makedirs(json_path, exist_ok=True)
@@ -400,37 +1987,56 @@ def create_txadmin_config(server_config, deploy_folder):
     with open(os.path.join(json_path, 'config.json'), 'w') as file:
         json.dump(config, file, indent=2)
 
-def process_template_deploy(builds):
-    print("Found deploy.json file. Using the values from the file.")
-    with open('deploy.json', 'r', encoding="utf-8") as file:
-        deploy_recipe = json.load(file)
-    db_connection, db_connection_string = validate_sql_connection({
-        'ip': deploy_recipe['sqlServer'],
-        'port': deploy_recipe['sqlPort'],
-        'user': deploy_recipe['sqlUser'],
-        'password': deploy_recipe['sqlPass'],
-        'db': deploy_recipe['sqlDb']
-    })
-    if not db_connection:
-        print("Exiting.")
-        return None
-    
-    recipe_location = 'recipe.yaml' if deploy_recipe['recipeUrl'].startswith('http') else deploy_recipe['recipeUrl']
-    if recipe_location == 'recipe.yaml':
-        download_file(deploy_recipe['recipeUrl'], recipe_location)
-    elif not os.path.exists(recipe_location):
-        print("Recipe file not found. Exiting.")
-        return None
-        
+def read_deploy_file(path='deploy.json'):
+    with open(path, 'r', encoding="utf-8") as file:
+        return expand_deploy_file(json.load(file))
+
+def valid_deploy_folder(folder):
+    # The folder becomes a single directory under txData and a log file name, it must not reach outside of them
+    return isinstance(folder, str) and folder not in ('', '.', '..') and not os.path.isabs(folder) \
+        and not re.search(r'[/\\:]', folder)
+
+def expand_deploy_file(deploy_file):
+    if isinstance(deploy_file, list):
+        deploy_recipes = deploy_file
+    elif 'deployments' in deploy_file:
+        # Shared settings go in "defaults", every deployment only lists what differs
+        defaults = deploy_file.get('defaults', {})
+        deploy_recipes = [dict(defaults, **deployment) for deployment in deploy_file['deployments']]
+    else:
+        deploy_recipes = [deploy_file]
+    for deploy_recipe in deploy_recipes:
+        if isinstance(deploy_recipe, dict) and 'deployFolder' in deploy_recipe and \
+                not valid_deploy_folder(deploy_recipe['deployFolder']):
+            raise ValueError(f"invalid deployFolder {deploy_recipe['deployFolder']!r}, use a plain folder name")
+    return deploy_recipes
+
+def process_template_deploy(builds, deploy_recipe):
+    print(f"Preparing deployment {deploy_recipe['deployFolder']} from deploy.json.")
+    if deploy_recipe['artifact'] not in builds:
+        print(f"Invalid build number {deploy_recipe['artifact']}. Exiting.")
+        return None, None
+    if deploy_recipe['recipeUrl'].startswith('http'):
+        try:
+            recipe_location, _ = cached_get(deploy_recipe['recipeUrl'])
+        except requests.RequestException as e:
+            print(f"Failed to download recipe: {e}. Exiting.")
+            return None, None
+    else:
+        recipe_location = deploy_recipe['recipeUrl']
+        if not os.path.exists(recipe_location):
+            print("Recipe file not found. Exiting.")
+            return None, None
+
     with open(recipe_location, 'r') as file:
         recipe = yaml.safe_load(file)
-        
+
     if deploy_recipe['removeGit']:
         recipe['tasks'].append({
             'action': 'remove_git',
             'path': '.git'
         })
-    
+
     return {
         "artifact_url": builds[deploy_recipe['artifact']],
         "recipe_url": deploy_recipe['recipeUrl'],
@@ -440,32 +2046,67 @@ def process_template_deploy(builds):
         "sql_password": deploy_recipe['sqlPass'],
         "sql_db": deploy_recipe['sqlDb'],
         "deploy_folder": deploy_recipe['deployFolder'],
-        "db_connection_string": db_connection_string,
+        # Validated by deploy_server while the recipe runs
+        "db_connection_string": None,
         "sv_license": deploy_recipe['svLicenseKey'],
         "server_name": deploy_recipe['serverName'],
         "max_clients": deploy_recipe['maxClients'],
         "recipe_name": recipe.get('name'),
         "recipe_author": recipe.get('author'),
-        "recipe_description": recipe.get('description')
+        "recipe_description": recipe.get('description'),
+        "tx_profile": deploy_recipe.get('txProfile')
     }, recipe
 
-def main():
-    print("Welcome to the fxServer server deployment script with txAdmin recipe support.")
-    #check if git is available
-    if not shutil.which('git'):
-        print("Git is required to download recipes. Please install git and try again.")
-        return
-    builds, recommended_build = fetch_build_numbers()
-    if os.path.exists('deploy.json'):
-        user_inputs, recipe = process_template_deploy(builds)
-    else:
-        user_inputs, recipe = prompt_user(builds, recommended_build)
+def print_setup_data(user_inputs):
+    print("\nServer setup data:")
+    print(f"Artifact URL: {user_inputs['artifact_url']}")
+    print(f"Recipe URL: {user_inputs['recipe_url']}")
+    print(f"Recipe Name: {user_inputs['recipe_name']}")
+    print(f"Recipe Author: {user_inputs['recipe_author']}")
+    print(f"Recipe Description: {user_inputs['recipe_description']}")
+    print(f"Deploy folder: {user_inputs['deploy_folder']}")
+    print(f"SQL IP: {user_inputs['sql_ip']}")
+    print(f"SQL Port: {user_inputs['sql_port']}")
+    print(f"SQL User: {user_inputs['sql_user']}")
+    print(f"SQL Database: {user_inputs['sql_db']}")
+    print(f"Server License: {user_inputs['sv_license']}")
+    print(f"Server Name: {user_inputs['server_name']}")
+    print(f"Max Clients: {user_inputs['max_clients']}")
 
-    if not user_inputs:
-        return
+def start_stage(name, func, *args):
+    # Runs one stage on its own thread, whoever needs its result joins it with .result()
+    def run():
+        with trace_span(name):
+            return func(*args)
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name.replace(' ', '-'))
+    future = executor.submit(run)
+    executor.shutdown(wait=False)
+    return future
 
-    artifact_url = user_inputs['artifact_url']
-    recipe_url = user_inputs['recipe_url']
+def install_server(artifact_url, archive_name, dest, stream=True):
+    # monitor.zip does not need the artifact, only extracting it into the artifact's tree does
+    monitor_zip = start_stage('fetch txAdmin', fetch_monitor)
+    with trace_span('install artifact'):
+        installed = install_artifact(artifact_url, archive_name, dest, stream=stream)
+    if not installed:
+        return False
+    print("Updating txAdmin...")
+    with trace_span('update txAdmin'):
+        replace_monitor_folder(dest, monitor_zip.result())
+    return True
+
+def server_current(deployments, artifact_url):
+    # An update keeps the installed server files while every deployment was made with this artifact
+    if not os.path.isdir(monitor_folder('fxServer')):
+        return False
+    key = artifact_cache_key(artifact_url)
+    for user_inputs, _ in deployments:
+        lock = load_lockfile(os.path.join('fxServer', 'txData', user_inputs['deploy_folder']))
+        if not lock or lock.get('artifact') != key:
+            return False
+    return True
+
+def deploy_server(user_inputs, recipe, options, profile='default'):
     deploy_folder = user_inputs['deploy_folder']
     sql_info = {
         'ip': user_inputs['sql_ip'],
@@ -474,7 +2115,7 @@ def main():
         'password': user_inputs['sql_password'],
         'db': user_inputs['sql_db']
     }
-    
+
     server_config = {
         'svLicense': user_inputs['sv_license'],
         'max_clients': user_inputs['max_clients'],
@@ -484,50 +2125,1222 @@ def main():
         'recipeDescription': user_inputs['recipe_description'],
         'dbConnectionString': user_inputs['db_connection_string']
     }
-        
+
+    manifest = {
+        'artifact_url': user_inputs['artifact_url'],
+        'artifact': artifact_cache_key(user_inputs['artifact_url']),
+        'recipe_url': user_inputs['recipe_url'],
+        'recipe_name': user_inputs['recipe_name']
+    }
+    sql_ready = None
+    if server_config['dbConnectionString'] is None:
+        sql_ready = start_stage('validate database', validate_sql_connection, sql_info)
+    if options.get('image'):
+        with trace_span('stamp image', deploy_folder=deploy_folder):
+            stamped = (sql_ready is None or sql_ready.result()) and stamp_image(options['image'], deploy_folder, sql_info)
+        if not stamped:
+            print("Stamping the image failed. Exiting.")
+            return False
+    else:
+        with trace_span('recipe', deploy_folder=deploy_folder):
+            succeeded = process_recipe(recipe, deploy_folder, sql_info, jobs=options['jobs'], stream=options['stream'],
+                                       sql_session=options['sql_session'], file_cache=options.get('file_cache', False),
+                                       manifest=manifest, update=options.get('update', False), sql_ready=sql_ready)
+        if not succeeded:
+            print("Recipe failed. Exiting.")
+            return False
+    if sql_ready is not None:
+        validated = sql_ready.result()
+        if not validated:
+            print("Database validation failed. Exiting.")
+            return False
+        server_config['dbConnectionString'] = validated[1]
+
+    with trace_span('server config', deploy_folder=deploy_folder):
+        # Setup server configuration
+        print("Setting up server configuration...")
+        template = update_server_cfg(deploy_folder, server_config)
+        record_template(os.path.join('fxServer', 'txData', deploy_folder), 'server.cfg', template)
+
+        # Create config.json file for txAdmin
+        print("Creating txAdmin config.json file...")
+        create_txadmin_config(server_config, deploy_folder, profile)
+
+    if options.get('snapshot'):
+        # The image holds the server files as well, so the snapshot waits for the artifact install
+        if options.get('server_ready') is not None and not options['server_ready'].result():
+            print("The server files were not installed, skipping the image.")
+            return True
+        with trace_span('snapshot', deploy_folder=deploy_folder):
+            if not snapshot_image(options['snapshot'], deploy_folder, sql_info):
+                print("Failed to save the image.")
+    return True
+
+# preflight checks
+REQUIRED_TASK_KEYS = {
+    'download_github': ('src', 'dest'),
+    'move_path': ('src', 'dest'),
+    'copy_path': ('src', 'dest'),
+    'download_file': ('url', 'path'),
+    'download_extract': ('url', 'path', 'dest'),
+    'unzip': ('src', 'dest'),
+    'remove_path': ('path',),
+    'ensure_dir': ('path',),
+    'write_file': ('file', 'data'),
+    'connect_database': (),
+    'query_database': (),
+    'remove_git': (),
+}
+# Rough ratio between an archive and what it extracts to, only used for the disk estimate
+ARCHIVE_EXPANSION = 3
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+
+def check_url(url):
+    try:
+        response = get_session().head(url, allow_redirects=True, headers=IDENTITY_ENCODING, timeout=DOWNLOAD_TIMEOUT)
+        if response.status_code in (403, 405, 501):
+            # Some hosts refuse HEAD, a streamed GET that is closed straight away does not fetch the body
+            response = get_session().get(url, stream=True, allow_redirects=True, headers=IDENTITY_ENCODING,
+                                         timeout=DOWNLOAD_TIMEOUT)
+            response.close()
+    except requests.RequestException as e:
+        return None, f"{url} is unreachable: {e}"
+    if response.status_code >= 400:
+        return None, f"{url} returned HTTP {response.status_code}"
+    return int(response.headers.get('content-length', 0)), None
+
+def check_git_source(src, ref):
+    # Never let git stop for a credential prompt, a private or missing repository is just an error here
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+    try:
+        result = subprocess.run(['git', 'ls-remote', src, 'HEAD'] + ([ref] if ref else []),
+                                capture_output=True, text=True, env=env, timeout=120)
+    except subprocess.TimeoutExpired:
+        return f"git ls-remote {src} timed out"
+    if result.returncode != 0:
+        reason = next((line for line in result.stderr.splitlines() if line.startswith('fatal:')), 'git ls-remote failed')
+        return f"cannot read repository {src} ({reason})"
+    names = {line.split('\t', 1)[1] for line in result.stdout.splitlines() if '\t' in line}
+    if ref and f"refs/heads/{ref}" not in names and f"refs/tags/{ref}" not in names:
+        return f"{src} has no branch or tag named '{ref}'"
+    return None
+
+def virtual_kind(tree, path):
+    # tree maps paths to 'file', 'dir' or 'tree', a directory whose contents are not known in advance
+    if path == '' or path in tree:
+        return tree.get(path, 'dir')
+    parts = path.split('/')
+    for index in range(len(parts) - 1, 0, -1):
+        kind = tree.get('/'.join(parts[:index]))
+        if kind == 'tree':
+            return 'tree'
+        if kind == 'file':
+            return None
+    prefix = path + '/'
+    return 'dir' if any(other.startswith(prefix) for other in tree) else None
+
+def virtual_remove(tree, path):
+    for other in [other for other in tree if other == path or other.startswith(path + '/')]:
+        del tree[other]
+
+def virtual_copy(tree, src, dest, move=False):
+    kind = virtual_kind(tree, src)
+    entries = {other: value for other, value in tree.items() if other == src or other.startswith(src + '/')}
+    if move:
+        virtual_remove(tree, src)
+    virtual_remove(tree, dest)
+    tree[dest] = 'tree' if kind == 'tree' else entries.get(src, kind)
+    for other, value in entries.items():
+        tree[dest + other[len(src):]] = value
+
+def simulate_recipe(tasks, existing=False):
+    # Replay the task list on paths only, to catch tasks that use a path no earlier task creates
+    tree = {'': 'tree'} if existing else {}
+    errors = []
+    warnings = []
+    for number, task in enumerate(tasks, 1):
+        action = task.get('action')
+        label = f"task {number} ({action})"
+        if action not in REQUIRED_TASK_KEYS:
+            warnings.append(f"{label}: unsupported action, it will be skipped")
+            continue
+        missing = [key for key in REQUIRED_TASK_KEYS[action] if key not in task]
+        if missing:
+            errors.append(f"{label}: missing {', '.join(missing)}")
+            continue
+        paths = {key: normalize_task_path(str(task[key])) for key in ('src', 'dest', 'path', 'file')
+                 if key in task and not (action == 'download_github' and key == 'src')}
+        if action == 'query_database' and 'file' not in task:
+            paths = {}
+        escaping = [path for path in paths.values() if path == '..' or path.startswith('../') or os.path.isabs(path)]
+        if escaping:
+            errors.append(f"{label}: {escaping[0]} is outside the deploy folder")
+            continue
+
+        if action in ('move_path', 'copy_path', 'unzip') and virtual_kind(tree, paths['src']) is None:
+            errors.append(f"{label}: {task['src']} does not exist at this point")
+            continue
+        if action == 'query_database' and 'file' in paths and virtual_kind(tree, paths['file']) is None:
+            errors.append(f"{label}: {task['file']} does not exist at this point")
+            continue
+
+        if action == 'download_github':
+            dest = paths['dest']
+            if tree.get(dest) == 'file' or any(other.startswith(dest + '/') for other in tree):
+                errors.append(f"{label}: {task['dest']} already exists, git cannot clone into it")
+            tree[paths['dest']] = 'tree'
+        elif action == 'move_path':
+            dest = paths['dest']
+            if virtual_kind(tree, dest) == 'dir':
+                dest = f"{dest}/{paths['src'].split('/')[-1]}".lstrip('/')
+            parent = dest.rpartition('/')[0]
+            if virtual_kind(tree, paths['src']) == 'file' and virtual_kind(tree, parent) is None:
+                errors.append(f"{label}: the parent folder of {task['dest']} does not exist")
+                continue
+            virtual_copy(tree, paths['src'], dest, move=True)
+        elif action == 'copy_path':
+            dest = paths['dest']
+            if virtual_kind(tree, dest) is not None and not task.get('overwrite', False):
+                warnings.append(f"{label}: {task['dest']} will already exist, the copy is skipped")
+                continue
+            if virtual_kind(tree, paths['src']) == 'file' and virtual_kind(tree, dest) == 'dir':
+                dest = f"{dest}/{paths['src'].split('/')[-1]}".lstrip('/')
+            virtual_copy(tree, paths['src'], dest)
+        elif action == 'download_file':
+            tree[paths['path']] = 'file'
+        elif action == 'download_extract':
+            tree[paths['path']] = 'file'
+            tree[paths['dest']] = 'tree'
+        elif action == 'unzip':
+            if virtual_kind(tree, paths['dest']) != 'tree':
+                tree[paths['dest']] = 'tree'
+        elif action == 'remove_path':
+            if virtual_kind(tree, paths['path']) is None:
+                warnings.append(f"{label}: {task['path']} does not exist at this point")
+            virtual_remove(tree, paths['path'])
+        elif action == 'ensure_dir':
+            if virtual_kind(tree, paths['path']) is None:
+                tree[paths['path']] = 'dir'
+        elif action == 'write_file':
+            parent = paths['file'].rpartition('/')[0]
+            if virtual_kind(tree, parent) not in ('dir', 'tree'):
+                errors.append(f"{label}: the folder of {task['file']} does not exist at this point")
+                continue
+            if virtual_kind(tree, paths['file']) is None:
+                tree[paths['file']] = 'file'
+    return errors, warnings
+
+def preflight(deployments, artifact_url=None, jobs=DEFAULT_JOBS, update=False):
+    errors = []
+    warnings = []
+    sources = set()
+    urls = {}
+    for user_inputs, recipe in deployments:
+        tasks = recipe.get('tasks') if isinstance(recipe, dict) else None
+        if not isinstance(tasks, list):
+            errors.append(f"{user_inputs['deploy_folder']}: the recipe has no task list")
+            continue
+        task_errors, task_warnings = simulate_recipe(tasks, existing=update)
+        prefix = f"{user_inputs['deploy_folder']}: " if len(deployments) > 1 else ''
+        errors += [prefix + error for error in task_errors]
+        warnings += [prefix + warning for warning in task_warnings]
+        for task in tasks:
+            if task.get('action') == 'download_github' and 'src' in task:
+                sources.add((task['src'], task.get('ref')))
+            elif task.get('action') in ('download_file', 'download_extract') and 'url' in task:
+                # A missing path is already reported by simulate_recipe
+                path = str(task.get('path', ''))
+                archive = tar_compression(path) is not None or path.endswith(('.zip', '.7z'))
+                urls[task['url']] = urls.get(task['url'], False) or archive
+
+    artifact_cached = artifact_url and os.path.exists(
+        os.path.join(ARTIFACT_CACHE_DIR, artifact_cache_key(artifact_url), 'meta.json'))
+    if artifact_url and not artifact_cached:
+        urls[artifact_url] = True
+
+    print(f"Preflight: checking {len(sources)} repositories and {len(urls)} downloads...")
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        git_futures = {executor.submit(check_git_source, src, ref): src for src, ref in sources}
+        url_futures = {executor.submit(check_url, url): url for url in urls}
+        errors += [future.result() for future in git_futures if future.result()]
+        sizes = {}
+        for future, url in url_futures.items():
+            size, error = future.result()
+            if error:
+                errors.append(error)
+            else:
+                sizes[url] = size
+
+    download_size = sum(sizes.values())
+    unknown = [url for url, size in sizes.items() if not size]
+    disk_size = sum(size * (1 + ARCHIVE_EXPANSION if urls[url] else 1) for url, size in sizes.items())
+    # A cached mirror is the best guess for how much a clone takes, anything else is unknown until it is cloned
+    mirrors = [git_mirror_path(src) for src, _ in sources] if GIT_CACHE_ENABLED else []
+    disk_size += sum(tree_size(mirror) for mirror in set(mirrors) if os.path.isdir(mirror))
+    free = shutil.disk_usage('.').free
+    print(f"Download size: {format_size(download_size)}"
+          + (f" (plus {len(unknown)} downloads of unknown size)" if unknown else ''))
+    print(f"Estimated disk usage: {format_size(disk_size)}, {format_size(free)} free")
+    if disk_size > free:
+        errors.append(f"not enough disk space, about {format_size(disk_size)} is needed")
+
+    for warning in warnings:
+        print(f"Preflight warning: {warning}")
+    for error in errors:
+        print(f"\033[91mPreflight error\033[0m: {error}")
+    return not errors
+
+# golden images
+IMAGE_DIR = os.environ.get('FXDEPLOY_IMAGE_DIR', 'images')
+SQL_DEFINER_PATTERN = re.compile(r"DEFINER=`[^`]*`@`[^`]*`\s*")
+
+def image_path(name):
+    return os.path.join(IMAGE_DIR, re.sub(r'[^A-Za-z0-9._-]+', '_', name))
+
+def load_image(name):
+    meta_path = os.path.join(image_path(name), 'image.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+def sql_literal(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, (int, float)) or type(value).__name__ == 'Decimal':
+        return str(value)
+    if isinstance(value, (bytes, bytearray)):
+        return f"X'{bytes(value).hex()}'" if value else "''"
+    if type(value).__name__ == 'timedelta':
+        # TIME columns come back as timedelta, whose str() is not valid for hours past 24
+        seconds = int(value.total_seconds())
+        sign = '-' if seconds < 0 else ''
+        hours, rest = divmod(abs(seconds), 3600)
+        return f"'{sign}{hours}:{rest // 60:02}:{rest % 60:02}'"
+    if isinstance(value, set):
+        value = ','.join(sorted(value))
+    value = str(value)
+    for char, escaped in (('\\', '\\\\'), ("'", "\\'"), ('\0', '\\0'), ('\n', '\\n'), ('\r', '\\r'), ('\x1a', '\\Z')):
+        value = value.replace(char, escaped)
+    return f"'{value}'"
+
+def dump_database(sql_info, path):
+    mysqldump = shutil.which('mysqldump') or shutil.which('mariadb-dump')
+    if mysqldump:
+        env = dict(os.environ, MYSQL_PWD=sql_info['password'] or '')
+        with open(path, 'w', encoding='utf-8') as file:
+            result = subprocess.run([mysqldump, f"--host={sql_info['ip']}", f"--port={sql_info['port']}", f"--user={sql_info['user']}",
+                                     '--single-transaction', '--routines', '--triggers', '--hex-blob', '--no-tablespaces',
+                                     sql_info['db']], stdout=file, stderr=subprocess.PIPE, text=True, env=env)
+        if result.returncode == 0:
+            return True
+        print(f"{os.path.basename(mysqldump)} failed, dumping table by table instead: {result.stderr.strip()}")
+
+    from mysql.connector import Error
+    connection = connect_database(sql_info)
+    if not connection:
+        return False
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SHOW FULL TABLES")
+        tables = cursor.fetchall()
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write("SET foreign_key_checks = 0;\n")
+            for table, kind in tables:
+                if kind != 'BASE TABLE':
+                    continue
+                cursor.execute(f"SHOW CREATE TABLE `{table}`")
+                file.write(f"{cursor.fetchone()[1]};\n")
+                cursor.execute(f"SELECT * FROM `{table}`")
+                while True:
+                    rows = cursor.fetchmany(SQL_BATCH_SIZE)
+                    if not rows:
+                        break
+                    values = ',\n'.join('(' + ', '.join(sql_literal(value) for value in row) + ')' for row in rows)
+                    file.write(f"INSERT INTO `{table}` VALUES\n{values};\n")
+            # Views last, they may select from any of the tables
+            for view, kind in tables:
+                if kind == 'VIEW':
+                    cursor.execute(f"SHOW CREATE VIEW `{view}`")
+                    file.write(f"{cursor.fetchone()[1]};\n")
+            file.write("SET foreign_key_checks = 1;\n")
+        cursor.close()
+    except Error as e:
+        print(f"Failed to dump database {sql_info['db']}: {e}")
+        return False
+    finally:
+        connection.close()
+    return True
+
+def snapshot_image(name, deploy_folder, sql_info):
+    recipe_dest = os.path.join('fxServer', 'txData', deploy_folder)
+    lock = load_lockfile(recipe_dest) or {}
+    template = lock.get('templates', {}).get('server.cfg')
+    if template is None:
+        print(f"{recipe_dest} has no server.cfg template in {LOCKFILE_NAME}, deploy it again to snapshot it.")
+        return False
+
+    start = time.perf_counter()
+    image = image_path(name)
+    staging = f"{image}.partial-{os.getpid()}"
+    if os.path.exists(staging):
+        shutil.rmtree(staging, onerror=onerror)
+    os.makedirs(os.path.join(staging, 'server'))
+    print(f"Snapshotting {deploy_folder} into image {name}...")
+    # Copies, not hardlinks, so later edits to the live server cannot leak into the image
+    for entry in os.scandir('fxServer'):
+        if entry.name == 'txData':
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            copy_tree(entry.path, os.path.join(staging, 'server', entry.name))
+        else:
+            clone_file(entry.path, os.path.join(staging, 'server', entry.name))
+    copy_tree(recipe_dest, os.path.join(staging, 'data'))
+    server_cfg = os.path.join(staging, 'data', 'server.cfg')
+    os.remove(server_cfg)
+    with open(server_cfg, 'w') as file:
+        file.write(template)
+
+    if not dump_database(sql_info, os.path.join(staging, 'database.sql')):
+        shutil.rmtree(staging, onerror=onerror)
+        return False
+
+    meta = {key: lock.get(key) for key in ('artifact_url', 'artifact', 'recipe_url', 'recipe_name')}
+    meta.update(name=name, source=deploy_folder, created=time.time(), database='database.sql')
+    with open(os.path.join(staging, 'image.json'), 'w', encoding='utf-8') as file:
+        json.dump(meta, file, indent=2)
+    remove_tree(image)
+    os.rename(staging, image)
+    print(f"Image {name} saved to {image} ({format_size(tree_size(image))}) in {time.perf_counter() - start:.1f}s")
+    return True
+
+def install_image(name):
+    # The server files are cloned out of the image the same way as out of the artifact cache
+    meta = load_image(name)
+    if meta is None:
+        return None
+    clone_tree(os.path.join(image_path(name), 'server'), 'fxServer')
+    return meta
+
+def stamp_image(name, deploy_folder, sql_info):
+    meta = load_image(name)
+    if meta is None:
+        print(f"Image {name} not found in {IMAGE_DIR}.")
+        return False
+    start = time.perf_counter()
+    image = image_path(name)
+    recipe_dest = os.path.join('fxServer', 'txData', deploy_folder)
+    # The data folder is cloned rather than linked, server owners edit these files in place
+    copy_tree(os.path.join(image, 'data'), recipe_dest, replace=True)
+
+    if meta.get('database'):
+        from tqdm import tqdm
+        connection = connect_database(sql_info)
+        if not connection:
+            return False
+        dump = os.path.join(image, meta['database'])
+        progress_bar = tqdm(total=os.path.getsize(dump), unit='B', unit_scale=True, desc=meta['database'])
+        # Definers name the user of the snapshotted database, which may not exist on this server
+        lines = (SQL_DEFINER_PATTERN.sub('', line) for line in read_sql_lines(dump, progress_bar))
+        try:
+            if not import_sql(connection, lines, meta['database'], progress_bar, FAST_SQL_SESSION):
+                return False
+        finally:
+            connection.close()
+    print(f"Stamped {deploy_folder} from image {name} in {time.perf_counter() - start:.1f}s")
+    return True
+
+# peer mirror
+def peer_url(endpoint, **params):
+    peer = DOWNLOAD_SETTINGS.get('peer')
+    if not peer:
+        return None
+    return f"{peer.rstrip('/')}/{endpoint}?{urlencode(params)}"
+
+def request_timeout(url):
+    peer = DOWNLOAD_SETTINGS.get('peer')
+    return PEER_TIMEOUT if peer and url.startswith(peer.rstrip('/') + '/') else DOWNLOAD_TIMEOUT
+
+def peer_get(endpoint, url, headers=None):
+    # Returns the peer's response, or None so the caller goes upstream instead
+    mirrored = peer_url(endpoint, url=url)
+    if not mirrored:
+        return None
+    try:
+        response = get_session().get(mirrored, headers=headers, stream=True, timeout=PEER_TIMEOUT)
+    except requests.RequestException as e:
+        print(f"Peer unavailable for {url} ({e}), using upstream.")
+        return None
+    if response.status_code >= 400:
+        response.close()
+        return None
+    return response
+
+def peer_git_source(src, ref):
+    # Has the peer bring its own mirror of src up to date, then git reads it over plain HTTP
+    mirrored = peer_url('git-mirror', src=src, ref=ref or '')
+    if not mirrored:
+        return None
+    try:
+        response = get_session().get(mirrored, timeout=PEER_TIMEOUT)
+        response.raise_for_status()
+        return DOWNLOAD_SETTINGS['peer'].rstrip('/') + response.json()['path']
+    except (requests.RequestException, ValueError, KeyError) as e:
+        print(f"Peer has no mirror of {src} ({e}), using upstream.")
+        return None
+
+def peer_lock(key):
+    with peer_guard:
+        return peer_locks.setdefault(key, threading.Lock())
+
+def peer_file(url):
+    # Artifacts never change for a build, so a cached archive is served as is
+    entry = os.path.join(ARTIFACT_CACHE_DIR, artifact_cache_key(url))
+    if os.path.exists(os.path.join(entry, 'meta.json')):
+        with open(os.path.join(entry, 'meta.json'), 'r') as file:
+            meta = json.load(file)
+        archive = os.path.join(entry, meta['archive'])
+        if meta.get('url') == url and os.path.exists(archive):
+            return archive
+    # Everything else is pulled into the file cache once and revalidated at most every HTTP_CACHE_TTL seconds
+    with peer_lock(url):
+        path = file_cache_path(url)
+        if os.path.exists(path) and time.time() - peer_checked.get(url, 0) < HTTP_CACHE_TTL:
+            return path
+        path = prefetch_file(url)
+        if path:
+            peer_checked[url] = time.time()
+        return path
+
+def peer_hosts():
+    # Only the known upstreams, so the peer cannot be used to reach other hosts of its network
+    return {urlsplit(known).hostname for known in (ARTIFACTS_URL, TXADMIN_URL, RECIPES_INDEX_URL)} | PEER_HOSTS
+
+def peer_allows_url(url):
+    parts = urlsplit(url)
+    return parts.scheme in ('http', 'https') and (parts.hostname or '').lower() in peer_hosts()
+
+def peer_allows_git(src):
+    # Remote repositories on the same hosts only, local paths and file:// would expose the peer's own disk
+    match = SCP_GIT_PATTERN.match(src)
+    if match:
+        scheme, host = 'ssh', match.group(1)
+    else:
+        parts = urlsplit(src)
+        scheme, host = parts.scheme, parts.hostname or ''
+    if scheme != 'https' and not (scheme == 'ssh' and PEER_GIT_SSH):
+        return False
+    return host.lower() in peer_hosts()
+
+def peer_git_mirror(src, ref):
+    with peer_lock(src):
+        mirror = update_git_mirror(src, ref or None)
+        if mirror is None:
+            return None
+        # info/refs and objects/info/packs are all a client needs to clone over dumb HTTP
+        subprocess.run(['git', '-C', mirror, 'update-server-info'])
+        peer_mirrors.add(os.path.basename(mirror))
+        return mirror
+
+class PeerHandler(BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        try:
+            if parts.path.startswith('/git/'):
+                self.send_git_file(unquote(parts.path[len('/git/'):]))
+            elif parts.path == '/git-mirror' and query.get('src'):
+                if not peer_allows_git(query['src']):
+                    self.send_error(403, "repository is not on a host in the peer's allowlist")
+                    return
+                mirror = peer_git_mirror(query['src'], query.get('ref'))
+                if mirror is None:
+                    self.send_error(502, f"could not mirror {query['src']}")
+                    return
+                self.send_json({'path': f"/git/{os.path.basename(mirror)}"})
+            elif parts.path in ('/file', '/http') and query.get('url'):
+                if not peer_allows_url(query['url']):
+                    self.send_error(403, "host is not in the peer's allowlist")
+                    return
+                self.send_url(parts.path[1:], query['url'])
+            else:
+                self.send_error(404)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def send_url(self, endpoint, url):
+        try:
+            if endpoint == 'file':
+                path, extra = peer_file(url), {}
+            else:
+                path, _ = cached_get(url)
+                with open(http_cache_paths(url)[0], 'r') as file:
+                    meta = json.load(file)
+                extra = {'ETag': meta.get('etag'), 'Last-Modified': meta.get('last_modified')}
+                if meta.get('etag') and self.headers.get('If-None-Match') == meta['etag']:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+        except requests.RequestException as e:
+            self.send_error(502, str(e))
+            return
+        if not path:
+            self.send_error(502, f"could not fetch {url}")
+            return
+        self.send_file(path, extra)
+
+    def send_git_file(self, relative):
+        root = os.path.realpath(GIT_CACHE_DIR)
+        path = os.path.realpath(os.path.join(root, relative))
+        # Only mirrors a peer asked for through /git-mirror, not every repository this node has cloned
+        if relative.split('/', 1)[0] not in peer_mirrors or not path.startswith(root + os.sep) or not os.path.isfile(path):
+            self.send_error(404)
+            return
+        self.send_file(path)
+
+    def send_json(self, value):
+        body = json.dumps(value).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_file(self, path, extra=None):
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get('Range', '').strip())
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2) or end), end)
+            else:
+                start = max(0, size - int(match.group(2)))
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', f"bytes */{size}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        for key, value in (extra or {}).items():
+            if value:
+                self.send_header(key, value)
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        with open(path, 'rb') as file:
+            file.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = file.read(min(DOWNLOAD_BLOCK_SIZE, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+def bind_address(address, host, port):
+    # Accepts PORT, HOST or HOST:PORT
+    if ':' in address:
+        address_host, _, address_port = address.rpartition(':')
+        return address_host or host, int(address_port or port)
+    if address.isdigit():
+        return host, int(address)
+    return address, port
+
+def serve_peer(address, hosts=(), git_ssh=False):
+    global PEER_GIT_SSH
+    host, port = bind_address(address, '127.0.0.1', PEER_PORT)
+    PEER_HOSTS.update(host.lower() for host in hosts)
+    PEER_GIT_SSH = PEER_GIT_SSH or git_ssh
+    server = ThreadingHTTPServer((host, port), PeerHandler)
+    # The peer itself always goes upstream, so two nodes pointing at each other cannot loop
+    DOWNLOAD_SETTINGS['peer'] = None
+    print(f"Serving {os.path.abspath(CACHE_DIR)} to peers on {host}:{server.server_address[1]}, press Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+# fleet deploys
+FLEET_LOG_DIR = 'logs'
+
+def prefetch_recipes(recipes, jobs):
+    # Fill the git mirrors and the file cache once so every server of the fleet clones and copies locally
+    sources = {}
+    urls = set()
+    for recipe in recipes:
+        for task in recipe['tasks']:
+            if task['action'] == 'download_github':
+                sources.setdefault(task['src'], set()).add(task.get('ref'))
+            elif task['action'] == 'download_file':
+                urls.add((task['url'], task.get('sha256'), task.get('size')))
+
+    work = []
+    if GIT_CACHE_ENABLED:
+        work += [(update_git_mirror, src, ref) for src, refs in sources.items() for ref in refs]
+    work += [(prefetch_file, url, sha256, size) for url, sha256, size in urls]
+    print(f"Prefetching {len(sources)} repositories and {len(urls)} files for the fleet...")
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = list(executor.map(lambda item: item[0](*item[1:]), work))
+    return all(result is not None and result is not False for result in results)
+
+def logged_deploy(log_path, deploy, *args):
+    # A pool process may run several deployments, each result only carries its own spans
+    with trace_guard:
+        trace_events.clear()
+        trace_totals.clear()
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    start = time.perf_counter()
+    streams = sys.stdout, sys.stderr
+    sys.stdout.flush()
+    sys.stderr.flush()
+    descriptors = os.dup(1), os.dup(2)
+    with open(log_path, 'w', buffering=1) as log:
+        # Point the file descriptors at the log too, so git and other subprocesses end up in it
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        sys.stdout = sys.stderr = log
+        try:
+            succeeded = deploy(*args)
+            error = None if succeeded else "deploy failed"
+        except Exception as e:
+            traceback.print_exc()
+            succeeded, error = False, f"{type(e).__name__}: {e}"
+        finally:
+            # The pool process runs more jobs, give it its own output back
+            log.flush()
+            sys.stdout, sys.stderr = streams
+            os.dup2(descriptors[0], 1)
+            os.dup2(descriptors[1], 2)
+            os.close(descriptors[0])
+            os.close(descriptors[1])
+    return {
+        'succeeded': succeeded,
+        'error': error,
+        'elapsed': time.perf_counter() - start,
+        'log': log_path,
+        # The worker's spans and counters travel back so the parent can export one trace for the fleet
+        'trace': trace_events,
+        'totals': trace_totals
+    }
+
+def server_profile(user_inputs):
+    # Each server of a fleet gets its own txAdmin profile next to its data folder
+    return user_inputs.get('tx_profile') or f"{user_inputs['deploy_folder']}_profile"
+
+def fleet_worker(user_inputs, recipe, options):
+    global git_mirror_refresh
+    DOWNLOAD_SETTINGS.update(options['download_settings'])
+    git_mirror_refresh = not options.get('file_cache')
+    log_path = os.path.join(FLEET_LOG_DIR, f"{user_inputs['deploy_folder']}.log")
+    result = logged_deploy(log_path, deploy_server, user_inputs, recipe, options, server_profile(user_inputs))
+    result['deploy_folder'] = user_inputs['deploy_folder']
+    return result
+
+def run_fleet(deployments, options, workers):
+    import multiprocessing
+    options = dict(options, file_cache=True, download_settings=dict(DOWNLOAD_SETTINGS))
+    if not options.get('image') and not prefetch_recipes([recipe for _, recipe in deployments], options['jobs']):
+        print("Some resources could not be prefetched, the affected servers will fetch them directly.")
+
+    print(f"Deploying {len(deployments)} servers with {workers} workers, logs are written to '{FLEET_LOG_DIR}'.")
+    results = []
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        futures = {
+            executor.submit(fleet_worker, user_inputs, recipe, options): user_inputs['deploy_folder']
+            for user_inputs, recipe in deployments
+        }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {'deploy_folder': futures[future], 'succeeded': False,
+                          'error': f"{type(e).__name__}: {e}", 'elapsed': 0, 'log': None}
+            with trace_guard:
+                trace_events.extend(result.pop('trace', []))
+                for counter, amount in result.pop('totals', {}).items():
+                    trace_totals[counter] = trace_totals.get(counter, 0) + amount
+            status = "\033[92mok\033[0m" if result['succeeded'] else "\033[91mfailed\033[0m"
+            print(f"{result['deploy_folder']}: {status} ({result['elapsed']:.1f}s)")
+            results.append(result)
+
+    print("\nFleet summary:")
+    for result in sorted(results, key=lambda result: result['deploy_folder']):
+        status = 'ok' if result['succeeded'] else f"failed ({result['error']})"
+        print(f"  {result['deploy_folder']:<24} {status:<40} log: {result['log']}")
+    succeeded = sum(1 for result in results if result['succeeded'])
+    print(f"{succeeded}/{len(results)} deployments succeeded.")
+    return succeeded == len(results)
+
+# deploy daemon
+DAEMON_PORT = 8731
+DAEMON_SQL_POOL_SIZE = 4
+DEPLOY_FILE_KEYS = ('artifact', 'recipeUrl', 'sqlServer', 'sqlPort', 'sqlUser', 'sqlPass', 'sqlDb', 'deployFolder',
+                    'svLicenseKey', 'serverName', 'maxClients', 'removeGit')
+ACTIVE_JOB_STATES = ('queued', 'running')
+
+def daemon_worker_init(download_settings, pool_size):
+    global sql_pool_size
+    DOWNLOAD_SETTINGS.update(download_settings)
+    sql_pool_size = pool_size
+    # Imported once when the worker starts instead of by every job
+    import importlib
+    importlib.import_module('tqdm')
+    try:
+        importlib.import_module('mysql.connector')
+    except ImportError:
+        pass
+
+def daemon_deploy(user_inputs, recipe, options):
+    global git_mirror_refresh
+    git_mirror_refresh = not options.get('file_cache')
+    if options.get('preflight'):
+        with trace_span('preflight'):
+            passed = preflight([(user_inputs, recipe)], jobs=options['jobs'])
+        if not passed:
+            print("Preflight checks failed.")
+            return False
+    print_setup_data(user_inputs)
+    return deploy_server(user_inputs, recipe, options, server_profile(user_inputs))
+
+def daemon_cached(name, load):
+    # The build list and recipe index stay in memory and are reloaded once older than HTTP_CACHE_TTL
+    with daemon_warm_guard:
+        entry = daemon_warm.get(name)
+        if entry is None or time.time() - entry[0] >= HTTP_CACHE_TTL:
+            entry = daemon_warm[name] = (time.time(), load())
+        return entry[1]
+
+def daemon_builds():
+    return daemon_cached('builds', lambda: fetch_build_numbers()[0])
+
+def daemon_server_files(artifact_url, stream):
+    # Jobs on the installed build share its install, a job on another build installs over it
+    global daemon_install
+    with daemon_guard:
+        if daemon_install and daemon_install[0] == artifact_url:
+            future = daemon_install[1]
+            if not future.done() or (future.exception() is None and future.result()):
+                return future
+        archive_name = 'server.7z' if os.name == 'nt' else 'fx.tar.xz'
+        future = daemon_installer.submit(install_server, artifact_url, archive_name, 'fxServer', stream)
+        daemon_install = (artifact_url, future)
+        return future
+
+def update_job(job, **values):
+    with daemon_guard:
+        job.update(values)
+
+def job_view(job):
+    with daemon_guard:
+        view = dict(job)
+    view.pop('artifact_url', None)
+    view['elapsed'] = round((view['finished'] or time.time()) - view['started'], 1) if view['started'] else None
+    return view
+
+def run_job(job, deploy_recipe, options):
+    update_job(job, state='running', started=time.time())
+    print(f"Job {job['id']}: deploying {job['deploy_folder']}, log in {job['log']}")
+    try:
+        server_files = daemon_server_files(job['artifact_url'], options['stream'])
+        user_inputs, recipe = process_template_deploy(daemon_builds(), deploy_recipe)
+        if not user_inputs:
+            result = {'succeeded': False, 'error': "the recipe could not be loaded"}
+        else:
+            # Mirrors are filled here, the workers only clone from them and fetch a ref that is still missing
+            if not prefetch_recipes([recipe], options['jobs']):
+                print(f"Job {job['id']}: some resources could not be prefetched.")
+            result = daemon_pool.submit(logged_deploy, job['log'], daemon_deploy, user_inputs, recipe, options).result()
+            if result['succeeded'] and not server_files.result():
+                result.update(succeeded=False, error="the server artifact could not be installed")
+    except Exception as e:
+        traceback.print_exc()
+        result = {'succeeded': False, 'error': f"{type(e).__name__}: {e}"}
+    stages = [{'name': event['name'], 'wall_s': round(event['dur'] / 1e6, 3)}
+              for event in result.get('trace', []) if event['cat'] == 'stage']
+    update_job(job, state='succeeded' if result['succeeded'] else 'failed', finished=time.time(),
+               error=result.get('error'), stages=stages)
+    print(f"Job {job['id']}: {job['state']}" + (f" ({job['error']})" if job['error'] else ''))
+
+def submit_jobs(deploy_file, options):
+    if not isinstance(deploy_file, (list, dict)):
+        return 400, {'error': "expected a deploy.json object or list"}
+    try:
+        deploy_recipes = expand_deploy_file(deploy_file)
+    except ValueError as e:
+        return 400, {'error': str(e)}
+    builds = daemon_builds()
+    for deploy_recipe in deploy_recipes:
+        if not isinstance(deploy_recipe, dict):
+            return 400, {'error': "every deployment must be an object"}
+        missing = [key for key in DEPLOY_FILE_KEYS if key not in deploy_recipe]
+        if missing:
+            return 400, {'error': f"{deploy_recipe.get('deployFolder', 'deployment')}: missing {', '.join(missing)}"}
+        if str(deploy_recipe['artifact']) not in builds:
+            return 400, {'error': f"{deploy_recipe['deployFolder']}: invalid build number {deploy_recipe['artifact']}"}
+    folders = [deploy_recipe['deployFolder'] for deploy_recipe in deploy_recipes]
+    artifacts = {str(deploy_recipe['artifact']) for deploy_recipe in deploy_recipes}
+
+    with daemon_guard:
+        active = [job for job in daemon_jobs.values() if job['state'] in ACTIVE_JOB_STATES]
+        busy = sorted({job['deploy_folder'] for job in active} & set(folders))
+        if busy or len(set(folders)) != len(folders):
+            return 409, {'error': f"already being deployed: {', '.join(busy) or 'duplicate deployFolder'}"}
+        # Every server shares one fxServer folder, so running jobs pin its build
+        artifacts |= {job['artifact'] for job in active}
+        if len(artifacts) > 1:
+            return 409, {'error': f"jobs on builds {', '.join(sorted(artifacts))} cannot run at the same time"}
+        jobs = []
+        for deploy_recipe in deploy_recipes:
+            job_id = str(len(daemon_jobs) + 1)
+            deploy_folder = deploy_recipe['deployFolder']
+            job = {
+                'id': job_id,
+                'deploy_folder': deploy_folder,
+                'artifact': str(deploy_recipe['artifact']),
+                'artifact_url': builds[str(deploy_recipe['artifact'])],
+                'recipe_url': deploy_recipe['recipeUrl'],
+                'state': 'queued',
+                'created': time.time(),
+                'started': None,
+                'finished': None,
+                'error': None,
+                'stages': [],
+                'log': os.path.join(FLEET_LOG_DIR, 'jobs', f"{job_id}-{deploy_folder}.log")
+            }
+            daemon_jobs[job_id] = job
+            jobs.append(job)
+    for job, deploy_recipe in zip(jobs, deploy_recipes):
+        daemon_queue.submit(run_job, job, dict(deploy_recipe, artifact=str(deploy_recipe['artifact'])), options)
+    return 202, {'jobs': [job_view(job) for job in jobs]}
+
+class DaemonHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        path = parts.path.rstrip('/')
+        query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        match = re.fullmatch(r'/jobs/([^/]+)(/log)?', path)
+        try:
+            if path == '/jobs':
+                with daemon_guard:
+                    jobs = list(daemon_jobs.values())
+                self.send_json({'jobs': [job_view(job) for job in jobs]})
+            elif match and match.group(1) not in daemon_jobs:
+                self.send_json({'error': f"no job {match.group(1)}"}, 404)
+            elif match and match.group(2):
+                self.stream_log(daemon_jobs[match.group(1)], query.get('follow', '1') != '0')
+            elif match:
+                self.send_json(job_view(daemon_jobs[match.group(1)]))
+            elif path == '/builds':
+                self.send_json({'builds': sorted(daemon_builds(), key=lambda build: int(build) if build.isdigit() else 0)})
+            elif path == '/recipes':
+                self.send_json({'recipes': daemon_cached('recipes', fetch_recipes)})
+            else:
+                self.send_json({'error': "not found"}, 404)
+        except requests.RequestException as e:
+            self.send_json({'error': str(e)}, 502)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_POST(self):
+        if urlsplit(self.path).path.rstrip('/') != '/jobs':
+            self.send_json({'error': "not found"}, 404)
+            return
+        # Browsers only send application/json cross-site after a CORS preflight, which the daemon never answers
+        if self.headers.get_content_type() != 'application/json':
+            self.send_json({'error': "expected Content-Type: application/json"}, 415)
+            return
+        try:
+            deploy_file = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'null')
+        except ValueError as e:
+            self.send_json({'error': f"invalid JSON: {e}"}, 400)
+            return
+        try:
+            status, payload = submit_jobs(deploy_file, self.server.options)
+        except requests.RequestException as e:
+            status, payload = 502, {'error': f"could not load the build list: {e}"}
+        self.send_json(payload, status)
+
+    def send_json(self, value, status=200):
+        body = json.dumps(value, indent=2).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream_log(self, job, follow):
+        # Sends the log as it is written and closes the response once the job has finished
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.end_headers()
+        self.close_connection = True
+        offset = 0
+        while True:
+            finished = job['state'] not in ACTIVE_JOB_STATES
+            if os.path.exists(job['log']):
+                with open(job['log'], 'rb') as file:
+                    file.seek(offset)
+                    chunk = file.read()
+                if chunk:
+                    self.wfile.write(chunk)
+                    self.wfile.flush()
+                    offset += len(chunk)
+            if finished or not follow:
+                return
+            time.sleep(0.25)
+
+def run_daemon(args, jobs):
+    global daemon_pool, daemon_queue, daemon_installer
+    import multiprocessing
+    if not shutil.which('git'):
+        print("Git is required to download recipes. Please install git and try again.")
+        return
+    empty_trash()
+    workers = max(1, args.fleet_workers or os.cpu_count() or 1)
+    options = {
+        'jobs': jobs,
+        'stream': args.stream,
+        'sql_session': FAST_SQL_SESSION if args.fast_sql else None,
+        'update': False,
+        'image': None,
+        'snapshot': None,
+        'file_cache': True,
+        'preflight': args.preflight
+    }
+    host, port = bind_address(args.daemon, '127.0.0.1', DAEMON_PORT)
+    server = ThreadingHTTPServer((host, port), DaemonHandler)
+    server.options = options
+
+    print(f"Starting {workers} deploy workers...")
+    daemon_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                      initializer=daemon_worker_init, initargs=(dict(DOWNLOAD_SETTINGS), DAEMON_SQL_POOL_SIZE))
+    # Every worker is started now, so a job never waits for an interpreter to boot
+    list(daemon_pool.map(time.sleep, [0] * workers))
+    daemon_queue = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+    daemon_installer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='install')
+    try:
+        print(f"{len(daemon_builds())} builds available.")
+    except requests.RequestException as e:
+        print(f"Could not load the build list yet: {e}")
+
+    print(f"Deploy daemon listening on http://{host}:{server.server_address[1]}, press Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon_queue.shutdown(wait=False, cancel_futures=True)
+        daemon_pool.shutdown(wait=True, cancel_futures=True)
+        daemon_installer.shutdown(wait=True)
+        wait_for_trash()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Deploy an fxServer installation from a txAdmin recipe.")
+    parser.add_argument('-j', '--jobs', type=int, default=DEFAULT_JOBS,
+                        help=f"number of independent recipe tasks to run at once (default {DEFAULT_JOBS})")
+    parser.add_argument('--serial', action='store_true',
+                        help="run recipe tasks strictly one after another in recipe order")
+    parser.add_argument('--retries', type=int, default=DOWNLOAD_SETTINGS['retries'],
+                        help=f"retries per download connection (default {DOWNLOAD_SETTINGS['retries']})")
+    parser.add_argument('--connections', type=int, default=DOWNLOAD_SETTINGS['connections'],
+                        help=f"parallel connections for large downloads (default {DOWNLOAD_SETTINGS['connections']})")
+    parser.add_argument('--fast-sql', action='store_true',
+                        help="disable foreign key and unique checks while importing recipe SQL files")
+    parser.add_argument('--fleet-workers', type=int, default=None,
+                        help="servers to deploy at once when deploy.json lists several deployments (default: CPU count)")
+    parser.add_argument('--update', action='store_true',
+                        help=f"update an existing deployment in place, re-running only the tasks whose inputs changed since {LOCKFILE_NAME} was written")
+    parser.add_argument('--no-stream', dest='stream', action='store_false',
+                        help="download archives to disk before extracting them instead of extracting while downloading")
+    parser.add_argument('-y', '--yes', action='store_true',
+                        help="deploy without asking for confirmation")
+    parser.add_argument('--check', action='store_true',
+                        help="only run the preflight checks of the recipes, then exit without deploying")
+    parser.add_argument('--no-preflight', dest='preflight', action='store_false',
+                        help="skip checking recipe paths, URLs and git refs before the deploy starts")
+    parser.add_argument('--snapshot', metavar='IMAGE',
+                        help=f"after deploying, save the server, its data folder and a dump of its database as an image in {IMAGE_DIR}")
+    parser.add_argument('--from-image', metavar='IMAGE',
+                        help="stamp the servers out of a saved image instead of running the artifact install and the recipe")
+    parser.add_argument('--serve', nargs='?', const=f"127.0.0.1:{PEER_PORT}", metavar='[HOST:]PORT',
+                        help=f"serve this node's artifact, file and git caches to other nodes over HTTP (default 127.0.0.1:{PEER_PORT}) instead of deploying")
+    parser.add_argument('--peer-host', action='append', default=[], metavar='HOST',
+                        help="with --serve, also fetch files and git repositories from HOST, for recipe sources hosted elsewhere (or set FXDEPLOY_PEER_HOSTS)")
+    parser.add_argument('--peer-git-ssh', action='store_true',
+                        help="with --serve, also mirror ssh:// and git@ repositories on the allowed hosts, using this node's ssh keys (or set FXDEPLOY_PEER_GIT_SSH=1)")
+    parser.add_argument('--daemon', nargs='?', const=f"127.0.0.1:{DAEMON_PORT}", metavar='[HOST:]PORT',
+                        help=f"run as a resident deploy daemon with an HTTP/JSON job API (default 127.0.0.1:{DAEMON_PORT}), using --fleet-workers worker processes")
+    parser.add_argument('--peer', metavar='URL', default=DOWNLOAD_SETTINGS['peer'],
+                        help="fetch artifacts, files, txAdmin and git repositories through a node running --serve first, falling back to upstream")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="write a Chrome trace (chrome://tracing, ui.perfetto.dev) of every stage and recipe task to FILE")
+    parser.add_argument('--summary', metavar='FILE',
+                        help="write a JSON summary of the wall and CPU time, bytes, files, SQL statements and git objects of every stage and task to FILE")
+    parser.add_argument('--profile', metavar='FILE',
+                        help="profile the deploy with cProfile, save the stats to FILE and print the most expensive calls")
+    return parser.parse_args()
+
+def main(args=None):
+    global profile_enabled
+    args = args or parse_args()
+    jobs = 1 if args.serial else max(1, args.jobs)
+    DOWNLOAD_SETTINGS['retries'] = max(0, args.retries)
+    DOWNLOAD_SETTINGS['connections'] = max(1, args.connections)
+    DOWNLOAD_SETTINGS['peer'] = args.peer
+    if args.serve:
+        serve_peer(args.serve, args.peer_host, args.peer_git_ssh)
+        return
+    if args.daemon:
+        run_daemon(args, jobs)
+        return
+    profile_enabled = bool(args.profile)
+    try:
+        with trace_span('deploy', 'run'):
+            run_deploy(args, jobs)
+    finally:
+        if args.trace:
+            write_trace(args.trace)
+            print(f"Trace written to {args.trace}")
+        if args.summary:
+            with open(args.summary, 'w', encoding='utf-8') as file:
+                json.dump(trace_summary(), file, indent=2)
+            print(f"Summary written to {args.summary}")
+        if args.profile:
+            write_profile(args.profile)
+
+def run_deploy(args, jobs):
+    print("Welcome to the fxServer server deployment script with txAdmin recipe support.")
+    #check if git is available
+    if not shutil.which('git'):
+        print("Git is required to download recipes. Please install git and try again.")
+        return
+    empty_trash()
+    with trace_span('fetch build index'):
+        builds, recommended_build = fetch_build_numbers()
+    if os.path.exists('deploy.json'):
+        print("Found deploy.json file. Using the values from the file.")
+        deployments = []
+        try:
+            deploy_recipes = read_deploy_file()
+        except ValueError as e:
+            print(f"Invalid deploy.json: {e}. Exiting.")
+            return
+        for deploy_recipe in deploy_recipes:
+            user_inputs, recipe = process_template_deploy(builds, deploy_recipe)
+            if not user_inputs:
+                return
+            deployments.append((user_inputs, recipe))
+    else:
+        user_inputs, recipe = prompt_user(builds, recommended_build, update=args.update)
+        if not user_inputs:
+            return
+        deployments = [(user_inputs, recipe)]
+
+    artifact_urls = {user_inputs['artifact_url'] for user_inputs, _ in deployments}
+    if len(artifact_urls) > 1:
+        print("All deployments in deploy.json must use the same artifact. Exiting.")
+        return
+    deploy_folders = [user_inputs['deploy_folder'] for user_inputs, _ in deployments]
+    if len(set(deploy_folders)) != len(deploy_folders):
+        print("Every deployment in deploy.json needs its own deployFolder. Exiting.")
+        return
+    if args.snapshot and (len(deployments) > 1 or args.from_image):
+        print("--snapshot needs a single deployment that is deployed from its recipe. Exiting.")
+        return
+    image = load_image(args.from_image) if args.from_image else None
+    if args.from_image and image is None:
+        print(f"Image {args.from_image} not found in {IMAGE_DIR}. Exiting.")
+        return
+    if image:
+        # Recipe tasks do not run, the artifact build and recipe come from the image
+        print(f"Stamping from image {args.from_image} (recipe {image.get('recipe_name')}, artifact {image.get('artifact')}).")
+
+    artifact_url = deployments[0][0]['artifact_url']
+    if not image and (args.preflight or args.check):
+        with trace_span('preflight'):
+            passed = preflight(deployments, artifact_url, jobs, update=args.update)
+        if not passed:
+            print("Preflight checks failed. Exiting.")
+            return
+        if args.check:
+            print("Preflight checks passed.")
+            return
+
     # Print Server setup data for confirmation
-    print("\nServer setup data:")
-    print(f"Artifact URL: {artifact_url}")
-    print(f"Recipe URL: {recipe_url}")
-    print(f"Recipe Name: {server_config['recipeName']}")
-    print(f"Recipe Author: {server_config['recipeAuthor']}")
-    print(f"Recipe Description: {server_config['recipeDescription']}")
-    print(f"Deploy folder: {deploy_folder}")
-    print(f"SQL IP: {sql_info['ip']}")
-    print(f"SQL Port: {sql_info['port']}")
-    print(f"SQL User: {sql_info['user']}")
-    print(f"SQL Database: {sql_info['db']}")
-    print(f"Server License: {server_config['svLicense']}")
-    print(f"Server Name: {server_config['serverName']}")
-    print(f"Max Clients: {server_config['max_clients']}")
+    for user_inputs, _ in deployments:
+        print_setup_data(user_inputs)
     
     # Get user confirmation to deploy
-    confirm_deploy = pyip.inputYesNo("Deploy the server with the above configuration? (y/n): ")
-    if not confirm_deploy:
-        print("Exiting.")
-        return
+    if not args.yes:
+        import pyinputplus as pyip
+        confirm_deploy = pyip.inputYesNo("Deploy the server with the above configuration? (y/n): ")
+        if not confirm_deploy:
+            print("Exiting.")
+            return
 
     print("Starting server install...")
     fx_server_archive = 'server.7z' if os.name == 'nt' else 'fx.tar.xz'
-    download_file(artifact_url, fx_server_archive)
-    extract_archive(fx_server_archive, 'fxServer')
-    print("Updating txAdmin...")
-    replace_monitor_folder('fxServer')
-    process_recipe(recipe, deploy_folder, sql_info)
-    
-    # Setup server configuration
-    print("Setting up server configuration...")
-    update_server_cfg(deploy_folder, server_config)
-    
-    # Create config.json file for txAdmin
-    print("Creating txAdmin config.json file...")
-    create_txadmin_config(server_config, deploy_folder)
-    
+    # The recipes only write to txData, so the server files install alongside them and are joined at the end
+    if image:
+        server_files = start_stage('install image', install_image, args.from_image)
+    elif args.update and server_current(deployments, artifact_url):
+        print(f"Server files are already on artifact {artifact_cache_key(artifact_url)}, keeping them.")
+        server_files = Future()
+        server_files.set_result(True)
+    else:
+        server_files = start_stage('install server', install_server, artifact_url, fx_server_archive, 'fxServer',
+                                   args.stream)
+
+    options = {
+        'jobs': jobs,
+        'stream': args.stream,
+        'sql_session': FAST_SQL_SESSION if args.fast_sql else None,
+        'update': args.update,
+        'image': args.from_image,
+        'snapshot': args.snapshot
+    }
+    if len(deployments) == 1:
+        user_inputs, recipe = deployments[0]
+        deployed = deploy_server(user_inputs, recipe, dict(options, server_ready=server_files))
+    else:
+        workers = max(1, min(args.fleet_workers or os.cpu_count() or 1, len(deployments)))
+        with trace_span('fleet', workers=workers):
+            deployed = run_fleet(deployments, options, workers)
+    if not server_files.result():
+        print("Failed to install server artifact. Exiting.")
+        return
+    if not deployed:
+        return
+
     print("Cleaning up...")
-    if os.path.exists(fx_server_archive):
-        os.remove(fx_server_archive)
-    if os.path.exists('recipe.yaml') and recipe_url.startswith('http'):
-        os.remove('recipe.yaml')
+    with trace_span('clean up'):
+        if os.path.exists(fx_server_archive):
+            os.remove(fx_server_archive)
+        if os.path.exists('recipe.yaml') and deployments[0][0]['recipe_url'].startswith('http'):
+            os.remove('recipe.yaml')
+        wait_for_trash()
 
     print("Server setup complete.")
 